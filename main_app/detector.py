@@ -0,0 +1,163 @@
+"""
+Model loading and raw detection shared by the API (in-process model) and the
+inference service processes.
+
+torch/ultralytics are imported lazily so API workers that send frames to the
+shared inference service never load them.
+"""
+import hashlib
+
+import cv2
+import numpy as np
+
+
+def empty_detections():
+    return (
+        np.zeros((0, 4), dtype=np.int32),
+        np.zeros(0, dtype=np.float32),
+        np.zeros(0, dtype=np.int64)
+    )
+
+
+def model_identity(model_path):
+    """Short content hash of the weights file, changes whenever the weights are replaced"""
+    digest = hashlib.sha256()
+    with open(model_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+# Patch PyTorch load function to handle newer security restrictions
+def safe_load_model(model_path):
+    import torch
+    from ultralytics import YOLO
+
+    try:
+        # Option 1: Try to load with regular settings (no verbose parameter)
+        return YOLO(model_path)
+    except TypeError as e:
+        if "unexpected keyword argument 'verbose'" in str(e):
+            print("Caught verbose parameter error, trying without it")
+            # The verbose parameter is not supported in this version
+            return YOLO(model_path)
+        else:
+            print(f"Standard loading failed with TypeError: {e}")
+            # Option 2: If that fails, monkey patch torch.load
+            original_torch_load = torch.load
+            
+            def patched_torch_load(f, *args, **kwargs):
+                kwargs['weights_only'] = False
+                return original_torch_load(f, *args, **kwargs)
+            
+            # Apply the monkey patch
+            torch.load = patched_torch_load
+            
+            try:
+                # Try loading with the patched function
+                return YOLO(model_path)
+            finally:
+                # Restore original function regardless of outcome
+                torch.load = original_torch_load
+    except Exception as e:
+        print(f"Model loading failed with error: {e}")
+        return None
+
+
+# Input size the YOLO models run at unless configured otherwise
+DEFAULT_IMGSZ = 640
+
+# YOLO input sizes must be multiples of the model stride
+MODEL_STRIDE = 32
+
+# IoU above which boxes of the same class from overlapping ROIs are merged
+ROI_NMS_IOU = 0.7
+
+
+def clip_rois(rois, width, height):
+    """Clip (x1, y1, x2, y2) regions to the image, dropping empty ones"""
+    clipped = []
+    for x1, y1, x2, y2 in rois:
+        x1, x2 = sorted(min(max(int(x), 0), width) for x in (x1, x2))
+        y1, y2 = sorted(min(max(int(y), 0), height) for y in (y1, y2))
+        if x2 > x1 and y2 > y1:
+            clipped.append((x1, y1, x2, y2))
+    return clipped
+
+
+def result_arrays(results, confidence_threshold, offsets=None):
+    """Detections above the threshold from ultralytics results, shifted by per-result (x, y) offsets"""
+    boxes, confidences, class_ids = [], [], []
+    
+    for i, r in enumerate(results):
+        if len(r.boxes) == 0:
+            continue
+        keep = (r.boxes.conf >= confidence_threshold).cpu().numpy()
+        xyxy = r.boxes.xyxy.cpu().numpy()[keep]
+        if offsets is not None:
+            x, y = offsets[i]
+            xyxy = xyxy + (x, y, x, y)
+        boxes.append(xyxy)
+        confidences.append(r.boxes.conf.cpu().numpy()[keep])
+        class_ids.append(r.boxes.cls.cpu().numpy()[keep])
+    
+    if not boxes:
+        return empty_detections()
+    
+    return (
+        np.concatenate(boxes).astype(np.int32),
+        np.concatenate(confidences).astype(np.float32),
+        np.concatenate(class_ids).astype(np.int64)
+    )
+
+
+def detect_arrays(model, image, confidence_threshold=0.5, rois=None, classes=None):
+    """
+    Run a YOLO model on a BGR image and return (boxes Nx4 int32,
+    confidences N float32, class_ids N int64) above the threshold.
+
+    `classes` limits detection to these class ids inside the model's NMS.
+    With `rois` [(x1, y1, x2, y2), ...] only those regions go through the
+    model, as one batch at the scale the full frame would have been run at,
+    and boxes are returned in full-image coordinates.
+    """
+    kwargs = {}
+    if classes is not None:
+        if len(classes) == 0:
+            return empty_detections()
+        kwargs["classes"] = [int(c) for c in classes]
+    
+    # ultralytics keeps the input size of the previous call, so full-frame
+    # passes set it explicitly after ROI passes have changed it
+    imgsz = getattr(model, "overrides", {}).get("imgsz") or DEFAULT_IMGSZ
+    if rois is None:
+        return result_arrays(model(image, imgsz=imgsz, **kwargs), confidence_threshold)
+    
+    img_height, img_width = image.shape[:2]
+    rois = clip_rois(rois, img_width, img_height)
+    if not rois:
+        return empty_detections()
+    
+    # Keep the full-frame scale so a small region costs a fraction of a full pass
+    # instead of being upscaled to the model's input size
+    if not isinstance(imgsz, int):
+        imgsz = max(imgsz)
+    scale = imgsz / max(img_height, img_width)
+    largest = max(max(x2 - x1, y2 - y1) for x1, y1, x2, y2 in rois)
+    kwargs["imgsz"] = min(imgsz, max(MODEL_STRIDE, -(-int(largest * scale) // MODEL_STRIDE) * MODEL_STRIDE))
+    
+    crops = [image[y1:y2, x1:x2] for x1, y1, x2, y2 in rois]
+    boxes, confidences, class_ids = result_arrays(
+        model(crops, **kwargs), confidence_threshold, [(x1, y1) for x1, y1, _, _ in rois]
+    )
+    
+    if len(rois) > 1 and len(boxes) > 1:
+        # Objects inside overlapping regions are found once per region
+        xywh = np.column_stack([boxes[:, :2], boxes[:, 2:] - boxes[:, :2]])
+        keep = cv2.dnn.NMSBoxesBatched(
+            xywh.tolist(), confidences.tolist(), class_ids.tolist(), 0.0, ROI_NMS_IOU
+        )
+        keep = np.sort(np.asarray(keep, dtype=np.int64).reshape(-1))
+        boxes, confidences, class_ids = boxes[keep], confidences[keep], class_ids[keep]
+    
+    return boxes, confidences, class_ids
@@ -0,0 +1,77 @@
+"""
+Change gating for frame sequences.
+
+Static or slow scenes (seabed shots, a paused ROV) produce runs of nearly
+identical frames. Each frame is reduced to a small grayscale signature and
+compared with the signature of the last frame that went through the model;
+while the mean absolute difference stays below the threshold the previous
+detections are reused instead of running inference again. Inference is
+still forced every `max_skipped_frames` frames so slow drift and objects
+entering the scene are not missed for long.
+"""
+import os
+
+import cv2
+import numpy as np
+
+# Mean absolute grayscale difference (0-255) below which a frame counts as unchanged
+CHANGE_THRESHOLD = float(os.environ.get("CHANGE_THRESHOLD", "2.0"))
+
+# Run inference at least once every this many frames (1 = on every frame)
+MAX_SKIPPED_FRAMES = int(os.environ.get("MAX_SKIPPED_FRAMES", "15"))
+
+# Edge of the downscaled signature in pixels
+SIGNATURE_SIZE = 32
+
+
+def frame_signature(frame):
+    """Downscaled grayscale signature of a BGR (or grayscale) frame"""
+    # Downscale first, so the colour conversion only touches a few pixels
+    small = cv2.resize(frame, (SIGNATURE_SIZE, SIGNATURE_SIZE), interpolation=cv2.INTER_AREA)
+    if small.ndim == 3:
+        small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    return small.astype(np.float32)
+
+
+class ChangeGate:
+    """
+    Decides per frame whether to run inference. Callers keep the detections
+    of inferred frames in `result` and reuse them for skipped frames.
+    """
+
+    def __init__(self, threshold=CHANGE_THRESHOLD, max_skipped_frames=MAX_SKIPPED_FRAMES):
+        self.threshold = threshold
+        self.max_skipped_frames = max_skipped_frames
+        self.result = None
+        self.inferred = 0
+        self.skipped = 0
+        self._signature = None
+        self._shape = None
+        self._run_length = 0
+
+    def should_infer(self, frame):
+        signature = frame_signature(frame)
+        unchanged = (
+            self.result is not None
+            and self._shape == frame.shape
+            # Skipping max_skipped_frames - 1 frames in a row means the model
+            # runs on every max_skipped_frames-th frame (1 = every frame)
+            and self._run_length < self.max_skipped_frames - 1
+            and float(np.mean(np.abs(signature - self._signature))) < self.threshold
+        )
+        if unchanged:
+            self.skipped += 1
+            self._run_length += 1
+            return False
+
+        # Compare following frames with this one, not with the previous frame,
+        # so slow drift adds up until it crosses the threshold
+        self._signature = signature
+        self._shape = frame.shape
+        self._run_length = 0
+        self.result = None
+        self.inferred += 1
+        return True
+
+    def stats(self):
+        return {"inferred_frames": self.inferred, "skipped_frames": self.skipped}
@@ -0,0 +1,280 @@
+"""
+Geo-tagged detection index for the map views.
+
+Detections with a position (EXIF GPS of the uploaded image or explicit form
+fields) are stored in SQLite:
+
+- every detection goes into `geo_detections` plus an R*Tree over
+  (lat, lng, time) for exact bounding-box / time-range lookups at high zoom
+- per zoom level, counts are pre-aggregated into grid cells per hour
+  (`geo_cells`), so a map view at any zoom reads at most one row per
+  visible cell and hour instead of every detection in the viewport
+
+Cluster queries return one marker per non-empty cell with its counts per
+category and a hotspot level (high/medium/low) derived from its density
+relative to the densest cell in view and a minimum absolute count.
+"""
+import os
+import time
+import sqlite3
+import threading
+from io import BytesIO
+
+from PIL import Image
+
+GEO_DB_PATH = os.environ.get("GEO_DB_PATH", "geo_detections.db")
+
+# Zoom levels with pre-aggregated cells; above this raw detections are clustered
+MAX_CLUSTER_ZOOM = 14
+
+# Deepest zoom of common web map tiles, queries are limited to it
+MAX_ZOOM = 22
+
+# Grid cells per 256px map tile edge, i.e. roughly one cluster per 64px
+CELLS_PER_TILE = 4
+
+# Seconds per time bucket of the pre-aggregated cells
+TIME_BUCKET_SECONDS = 3600
+
+# Hotspot thresholds as a fraction of the densest cell in view
+HIGH_DENSITY = 0.5
+MEDIUM_DENSITY = 0.2
+
+# Detections a cell needs for a level regardless of the rest of the view,
+# so a lone detection is not "high" just because nothing denser is in view
+HIGH_MIN_COUNT = 10
+MEDIUM_MIN_COUNT = 3
+
+CATEGORIES = ("hazardous_trash", "non_hazardous_trash", "aquatic_life")
+
+# EXIF tags
+GPS_INFO_TAG = 0x8825
+GPS_LATITUDE_REF, GPS_LATITUDE, GPS_LONGITUDE_REF, GPS_LONGITUDE = 1, 2, 3, 4
+
+
+def gps_from_exif(contents):
+    """Return (lat, lng) from the EXIF GPS block of an encoded image, or None"""
+    try:
+        gps = Image.open(BytesIO(contents)).getexif().get_ifd(GPS_INFO_TAG)
+        if GPS_LATITUDE not in gps or GPS_LONGITUDE not in gps:
+            return None
+
+        def to_degrees(value):
+            degrees, minutes, seconds = (float(part) for part in value)
+            return degrees + minutes / 60 + seconds / 3600
+
+        lat = to_degrees(gps[GPS_LATITUDE])
+        lng = to_degrees(gps[GPS_LONGITUDE])
+        if gps.get(GPS_LATITUDE_REF, "N") == "S":
+            lat = -lat
+        if gps.get(GPS_LONGITUDE_REF, "E") == "W":
+            lng = -lng
+        return lat, lng
+    except Exception as e:
+        print(f"Could not read EXIF GPS: {e}")
+        return None
+
+
+def valid_position(lat, lng):
+    return lat is not None and lng is not None and -90 <= lat <= 90 and -180 <= lng <= 180
+
+
+def cell_size(zoom):
+    """Cell edge in degrees at a zoom level"""
+    return 360.0 / (2 ** zoom * CELLS_PER_TILE)
+
+
+def cell_of(lat, lng, zoom):
+    size = cell_size(zoom)
+    return int((lng + 180) // size), int((lat + 90) // size)
+
+
+def lng_ranges(min_lng, max_lng):
+    """
+    Split a viewport's longitude span into ranges within [-180, 180]. Map
+    libraries report longitudes beyond +-180 when panned across the
+    antimeridian or zoomed out past one copy of the world, or a west edge
+    greater than the east edge when the view crosses the antimeridian.
+    """
+    width = max_lng - min_lng
+    if width < 0:
+        width += 360
+    if width >= 360:
+        return [(-180.0, 180.0)]
+    west = (min_lng + 180) % 360 - 180
+    east = west + width
+    if east <= 180:
+        return [(west, east)]
+    return [(west, 180.0), (-180.0, east - 360)]
+
+
+def hotspot_level(count, max_count):
+    if count >= HIGH_MIN_COUNT and count >= HIGH_DENSITY * max_count:
+        return "high"
+    if count >= MEDIUM_MIN_COUNT and count >= MEDIUM_DENSITY * max_count:
+        return "medium"
+    return "low"
+
+
+class GeoIndex:
+    def __init__(self, path=GEO_DB_PATH):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS geo_detections (
+                id INTEGER PRIMARY KEY,
+                ts REAL NOT NULL,
+                lat REAL NOT NULL,
+                lng REAL NOT NULL,
+                class_name TEXT NOT NULL,
+                category TEXT NOT NULL,
+                confidence REAL NOT NULL
+            );
+            CREATE VIRTUAL TABLE IF NOT EXISTS geo_rtree USING rtree(
+                id, min_lat, max_lat, min_lng, max_lng, min_ts, max_ts
+            );
+            CREATE TABLE IF NOT EXISTS geo_cells (
+                zoom INTEGER NOT NULL,
+                gy INTEGER NOT NULL,
+                gx INTEGER NOT NULL,
+                bucket INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                sum_lat REAL NOT NULL,
+                sum_lng REAL NOT NULL,
+                hazardous_trash INTEGER NOT NULL,
+                non_hazardous_trash INTEGER NOT NULL,
+                aquatic_life INTEGER NOT NULL,
+                PRIMARY KEY (zoom, gy, gx, bucket)
+            ) WITHOUT ROWID;
+        """)
+        self._db.commit()
+
+    def add(self, lat, lng, detections, ts=None):
+        """Index detections [(class_name, category, confidence), ...] seen at (lat, lng)"""
+        if not detections or not valid_position(lat, lng):
+            return 0
+        ts = time.time() if ts is None else ts
+        bucket = int(ts // TIME_BUCKET_SECONDS)
+
+        category_counts = [sum(1 for _, category, _ in detections if category == name) for name in CATEGORIES]
+        cells = [(zoom, *cell_of(lat, lng, zoom)[::-1]) for zoom in range(MAX_CLUSTER_ZOOM + 1)]
+        count = len(detections)
+
+        with self._lock:
+            cursor = self._db.cursor()
+            for class_name, category, confidence in detections:
+                cursor.execute(
+                    "INSERT INTO geo_detections (ts, lat, lng, class_name, category, confidence) VALUES (?, ?, ?, ?, ?, ?)",
+                    (ts, lat, lng, class_name, category, float(confidence)),
+                )
+                cursor.execute(
+                    "INSERT INTO geo_rtree VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (cursor.lastrowid, lat, lat, lng, lng, ts, ts),
+                )
+            cursor.executemany(
+                """
+                INSERT INTO geo_cells VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (zoom, gy, gx, bucket) DO UPDATE SET
+                    count = count + excluded.count,
+                    sum_lat = sum_lat + excluded.sum_lat,
+                    sum_lng = sum_lng + excluded.sum_lng,
+                    hazardous_trash = hazardous_trash + excluded.hazardous_trash,
+                    non_hazardous_trash = non_hazardous_trash + excluded.non_hazardous_trash,
+                    aquatic_life = aquatic_life + excluded.aquatic_life
+                """,
+                [
+                    (zoom, gy, gx, bucket, count, lat * count, lng * count, *category_counts)
+                    for zoom, gy, gx in cells
+                ],
+            )
+            self._db.commit()
+        return count
+
+    def clusters(self, min_lat, min_lng, max_lat, max_lng, zoom, start=None, end=None):
+        """
+        Clusters of detections inside a bounding box (and optional time range)
+        aggregated for a zoom level, each with a hotspot level.
+        """
+        zoom = max(0, int(zoom))
+        start = 0 if start is None else start
+        end = time.time() if end is None else end
+        min_lat, max_lat = max(min_lat, -90.0), min(max_lat, 90.0)
+
+        query = self._aggregated_cells if zoom <= MAX_CLUSTER_ZOOM else self._raw_cells
+        rows = []
+        for west, east in lng_ranges(min_lng, max_lng):
+            rows += query(min_lat, west, max_lat, east, zoom, start, end)
+
+        max_count = max((row[2] for row in rows), default=0)
+        clusters = []
+        for gx, gy, count, sum_lat, sum_lng, hazardous, non_hazardous, aquatic in rows:
+            clusters.append({
+                "id": f"{zoom}/{gx}/{gy}",
+                "position": {"lat": sum_lat / count, "lng": sum_lng / count},
+                "count": count,
+                "hazardous_trash": hazardous,
+                "non_hazardous_trash": non_hazardous,
+                "aquatic_life": aquatic,
+                "level": hotspot_level(count, max_count),
+            })
+        return clusters
+
+    def _aggregated_cells(self, min_lat, min_lng, max_lat, max_lng, zoom, start, end):
+        gx0, gy0 = cell_of(min_lat, min_lng, zoom)
+        gx1, gy1 = cell_of(max_lat, max_lng, zoom)
+        # Time buckets are hourly, so the range is widened to whole hours
+        with self._lock:
+            return self._db.execute(
+                """
+                SELECT gx, gy, SUM(count), SUM(sum_lat), SUM(sum_lng),
+                       SUM(hazardous_trash), SUM(non_hazardous_trash), SUM(aquatic_life)
+                FROM geo_cells
+                WHERE zoom = ? AND gy BETWEEN ? AND ? AND gx BETWEEN ? AND ? AND bucket BETWEEN ? AND ?
+                GROUP BY gx, gy
+                """,
+                (zoom, gy0, gy1, gx0, gx1, int(start // TIME_BUCKET_SECONDS), int(end // TIME_BUCKET_SECONDS)),
+            ).fetchall()
+
+    def _raw_cells(self, min_lat, min_lng, max_lat, max_lng, zoom, start, end):
+        # Beyond the pre-aggregated zooms the viewport is small enough to
+        # cluster the individual detections found through the R*Tree
+        size = cell_size(zoom)
+        with self._lock:
+            return self._db.execute(
+                """
+                SELECT CAST((d.lng + 180) / ? AS INTEGER) AS gx, CAST((d.lat + 90) / ? AS INTEGER) AS gy,
+                       COUNT(*), SUM(d.lat), SUM(d.lng),
+                       SUM(d.category = 'hazardous_trash'), SUM(d.category = 'non_hazardous_trash'),
+                       SUM(d.category = 'aquatic_life')
+                FROM geo_rtree r JOIN geo_detections d ON d.id = r.id
+                WHERE r.max_lat >= ? AND r.min_lat <= ? AND r.max_lng >= ? AND r.min_lng <= ?
+                  AND r.max_ts >= ? AND r.min_ts <= ?
+                  AND d.lat BETWEEN ? AND ? AND d.lng BETWEEN ? AND ? AND d.ts BETWEEN ? AND ?
+                GROUP BY gx, gy
+                """,
+                (size, size, min_lat, max_lat, min_lng, max_lng, start, end,
+                 min_lat, max_lat, min_lng, max_lng, start, end),
+            ).fetchall()
+
+    def hotspots(self, min_lat=-90, min_lng=-180, max_lat=90, max_lng=180, zoom=3, start=None, end=None, limit=10):
+        """Densest trash clusters (aquatic life excluded) in view, most polluted first"""
+        clusters = self.clusters(min_lat, min_lng, max_lat, max_lng, zoom, start, end)
+        trash = [
+            {**cluster, "trash_count": cluster["hazardous_trash"] + cluster["non_hazardous_trash"]}
+            for cluster in clusters
+        ]
+        trash = [cluster for cluster in trash if cluster["trash_count"]]
+        max_trash = max((cluster["trash_count"] for cluster in trash), default=0)
+
+        hotspots = []
+        for cluster in sorted(trash, key=lambda c: c["trash_count"], reverse=True)[:limit]:
+            position = cluster["position"]
+            hotspots.append({
+                "id": cluster["id"],
+                "name": f"{position['lat']:.3f}, {position['lng']:.3f}",
+                "position": position,
+                "count": cluster["trash_count"],
+                "level": hotspot_level(cluster["trash_count"], max_trash),
+            })
+        return hotspots
@@ -0,0 +1,480 @@
+"""
+Shared inference service for multi-worker deployments.
+
+A fixed number of inference processes own the YOLO model. Any number of
+uvicorn API workers decode images and hand frames to them through shared
+memory: only the segment name, shape and threshold travel over the socket,
+pixel data is never pickled. Detections come back as small numpy arrays.
+
+Model memory stays constant no matter how many HTTP workers run, and HTTP
+capacity and inference capacity can be scaled separately.
+
+Start the service (one process per port, starting at --port):
+
+    python inference_service.py --model best.pt --workers 2 --port 8765 --threads 4
+
+Then point the API workers at it:
+
+    INFERENCE_SERVICE=127.0.0.1:8765,127.0.0.1:8766 uvicorn main:app --workers 8
+
+Both sides must run on the same host (shared memory). Connections carry
+pickled data, so they are authenticated with a shared key: INFERENCE_AUTHKEY
+when set, otherwise the supervisor generates a random key and writes it to
+INFERENCE_AUTHKEY_FILE (default .inference_authkey, mode 0600), where the
+API workers read it. Listening on a non-loopback address requires an
+explicit INFERENCE_AUTHKEY.
+
+The supervisor restarts inference processes that crash; clients reconnect
+and fail over to the remaining processes in the meantime.
+"""
+import os
+import sys
+import time
+import socket
+import secrets
+import argparse
+import ipaddress
+import threading
+import itertools
+import multiprocessing
+from multiprocessing import shared_memory
+from multiprocessing.connection import Listener, Client, wait
+from multiprocessing import AuthenticationError
+
+import numpy as np
+
+from detector import detect_arrays, model_identity, safe_load_model
+
+# File the generated key is shared through when INFERENCE_AUTHKEY is not set
+AUTHKEY_FILE = os.environ.get("INFERENCE_AUTHKEY_FILE", ".inference_authkey")
+
+# Seconds to wait for a detection before treating the inference process as hung
+REQUEST_TIMEOUT = float(os.environ.get("INFERENCE_TIMEOUT", "60"))
+
+# Delay before restarting a crashed inference process, avoids hot crash loops
+RESTART_DELAY = 1.0
+
+# Seconds a client skips an inference process after it failed
+FAILURE_BACKOFF = 2.0
+
+# Seconds a single model pass may take before the process counts as hung and is restarted
+HANG_TIMEOUT = float(os.environ.get("INFERENCE_HANG_TIMEOUT", str(REQUEST_TIMEOUT)))
+
+# Inference processes report liveness this often; a process silent for
+# LIVENESS_TIMEOUT seconds (e.g. deadlocked) is restarted
+HEARTBEAT_INTERVAL = 1.0
+LIVENESS_TIMEOUT = 30.0
+
+# Slots of the shared per-process status array
+HEARTBEAT, BUSY_SINCE = 0, 1
+
+# Connection errors after which a client reconnects / fails over. A rejected
+# key is one too: a restarted supervisor may have generated a new one
+CONNECTION_ERRORS = (EOFError, OSError, TimeoutError, AuthenticationError)
+
+
+def explicit_authkey():
+    value = os.environ.get("INFERENCE_AUTHKEY")
+    return value.encode() if value else None
+
+
+def is_loopback(host):
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        return False
+
+
+def server_authkey(host):
+    """
+    Key the inference processes accept. Without INFERENCE_AUTHKEY a random
+    key is generated and shared with the API workers through AUTHKEY_FILE,
+    which only works on loopback: remote clients could not read the file.
+    """
+    authkey = explicit_authkey()
+    if authkey is not None:
+        return authkey
+    if not is_loopback(host):
+        raise SystemExit(f"Refusing to listen on {host} without INFERENCE_AUTHKEY")
+
+    authkey = secrets.token_hex(32).encode()
+    # Created private; replaced in full so clients never read a partial key
+    tmp_path = f"{AUTHKEY_FILE}.{os.getpid()}"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(authkey)
+    os.replace(tmp_path, AUTHKEY_FILE)
+    return authkey
+
+
+def client_authkey():
+    """Key API workers connect with: INFERENCE_AUTHKEY, or the one generated by the supervisor"""
+    authkey = explicit_authkey()
+    if authkey is not None:
+        return authkey
+    # Read on every connect, a restarted supervisor generates a new key
+    with open(AUTHKEY_FILE, "rb") as f:
+        return f.read().strip()
+
+
+def attach_shared_memory(name):
+    shm = shared_memory.SharedMemory(name=name)
+    # The API worker that created the segment owns it. Stop this process's
+    # resource tracker from unlinking it (and warning about a leak) on exit.
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except Exception:
+        pass
+    return shm
+
+
+# Inference process side ---------------------------------------------------
+
+def heartbeat(status):
+    while True:
+        status[HEARTBEAT] = time.time()
+        time.sleep(HEARTBEAT_INTERVAL)
+
+
+def handle_connection(conn, model, model_lock, model_id, status=None):
+    shm = None
+    try:
+        conn.send({"names": dict(model.names), "model_id": model_id})
+        while True:
+            request = conn.recv()
+            try:
+                # Clients reuse one segment and only replace it when frames grow
+                if shm is None or shm.name != request["shm"]:
+                    if shm is not None:
+                        shm.close()
+                    shm = attach_shared_memory(request["shm"])
+
+                frame = np.ndarray(request["shape"], dtype=np.uint8, buffer=shm.buf)
+                with model_lock:
+                    if status is not None:
+                        # Lets the supervisor spot a model pass that never returns
+                        status[BUSY_SINCE] = time.time()
+                    try:
+                        result = detect_arrays(
+                            model, frame, request["confidence_threshold"], request.get("rois"), request.get("classes")
+                        )
+                    finally:
+                        if status is not None:
+                            status[BUSY_SINCE] = 0.0
+                del frame  # Release the view so the segment can be closed later
+
+                conn.send({"ok": True, "result": result})
+            except CONNECTION_ERRORS:
+                raise
+            except Exception as e:
+                conn.send({"ok": False, "error": str(e)})
+    except CONNECTION_ERRORS:
+        pass
+    finally:
+        if shm is not None:
+            shm.close()
+        conn.close()
+
+
+def serve(address, model_path, threads, authkey, status=None):
+    """Entry point of one inference process"""
+    if status is not None:
+        # Started before the model loads, which can take a while
+        threading.Thread(target=heartbeat, args=(status,), daemon=True).start()
+
+    if threads:
+        import torch
+        torch.set_num_threads(threads)
+
+    model = safe_load_model(model_path)
+    if model is None:
+        print(f"Inference worker {address}: could not load {model_path}")
+        sys.exit(1)
+    model_id = model_identity(model_path)
+
+    # One model pass at a time per process; connections are served by threads
+    model_lock = threading.Lock()
+    listener = Listener(address, authkey=authkey)
+    print(f"Inference worker listening on {address[0]}:{address[1]}")
+
+    while True:
+        try:
+            conn = listener.accept()
+        except Exception as e:
+            # e.g. a client failing authentication
+            print(f"Inference worker {address}: rejected connection: {e}")
+            continue
+        threading.Thread(target=handle_connection, args=(conn, model, model_lock, model_id, status), daemon=True).start()
+
+
+def run_supervisor(model_path, workers, host, port, threads, authkey=None):
+    """Start `workers` inference processes and restart them when they die or hang"""
+    if authkey is None:
+        authkey = server_authkey(host)
+    ctx = multiprocessing.get_context("spawn")
+    processes = {}
+    statuses = {}
+
+    def start(index):
+        # [last heartbeat, start of the running model pass or 0], written by the process
+        status = ctx.Array("d", [time.time(), 0.0], lock=False)
+        process = ctx.Process(
+            target=serve,
+            args=((host, port + index), model_path, threads, authkey, status),
+            name=f"inference-{index}",
+            daemon=True,
+        )
+        process.start()
+        processes[index] = process
+        statuses[index] = status
+
+    def unresponsive(index):
+        now = time.time()
+        status = statuses[index]
+        if now - status[HEARTBEAT] > LIVENESS_TIMEOUT:
+            return f"no heartbeat for {now - status[HEARTBEAT]:.0f}s"
+        if status[BUSY_SINCE] and now - status[BUSY_SINCE] > HANG_TIMEOUT:
+            return f"model pass running for {now - status[BUSY_SINCE]:.0f}s"
+        return None
+
+    for index in range(workers):
+        start(index)
+
+    try:
+        while True:
+            wait([process.sentinel for process in processes.values()], timeout=HEARTBEAT_INTERVAL)
+            for index, process in list(processes.items()):
+                if not process.is_alive():
+                    print(f"Inference worker {index} exited with code {process.exitcode}, restarting")
+                    time.sleep(RESTART_DELAY)
+                    start(index)
+                    continue
+                reason = unresponsive(index)
+                if reason is not None:
+                    # Clients time out on it but would keep coming back after their backoff
+                    print(f"Inference worker {index} is unresponsive ({reason}), restarting")
+                    process.kill()
+                    process.join()
+                    start(index)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            process.join()
+
+
+# API worker side ----------------------------------------------------------
+
+class InferenceChannel:
+    """Connection to one inference process plus the shared memory segment used to send frames"""
+
+    def __init__(self, address, authkey):
+        self.address = address
+        self.authkey = authkey
+        self.lock = threading.Lock()
+        self.conn = None
+        self.shm = None
+        self.names = None
+        self.model_id = None
+        # Skipped by the client until this time after a failure
+        self.retry_at = 0.0
+
+    def connect(self):
+        self.conn = Client(self.address, authkey=self.authkey or client_authkey())
+        if not self.conn.poll(REQUEST_TIMEOUT):
+            raise TimeoutError(f"No handshake from inference worker {self.address}")
+        handshake = self.conn.recv()
+        self.names = handshake["names"]
+        self.model_id = handshake["model_id"]
+
+    def alive(self):
+        """
+        Whether the idle connection is still open. The service never sends
+        unprompted, so a readable connection means it was closed (e.g. the
+        process was killed or restarted); it is dropped then.
+        """
+        if self.conn is None:
+            return False
+        try:
+            if not self.conn.poll(0):
+                return True
+        except (OSError, EOFError):
+            pass
+        self.disconnect()
+        return False
+
+    def _buffer_for(self, nbytes):
+        if self.shm is None or self.shm.size < nbytes:
+            self.release_buffer()
+            self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        return self.shm
+
+    def detect(self, image, confidence_threshold, rois=None, classes=None):
+        # A restarted process may run other weights, so model_id must come
+        # from a fresh handshake rather than the dead connection
+        if not self.alive():
+            self.connect()
+
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        shm = self._buffer_for(image.nbytes)
+        view = np.ndarray(image.shape, dtype=np.uint8, buffer=shm.buf)
+        view[...] = image
+        del view
+
+        self.conn.send({
+            "shm": shm.name,
+            "shape": image.shape,
+            "confidence_threshold": confidence_threshold,
+            "rois": rois,
+            "classes": classes,
+        })
+        if not self.conn.poll(REQUEST_TIMEOUT):
+            raise TimeoutError(f"Inference worker {self.address} did not answer in {REQUEST_TIMEOUT}s")
+        response = self.conn.recv()
+        if not response["ok"]:
+            raise RuntimeError(f"Inference failed: {response['error']}")
+        return response["result"]
+
+    def disconnect(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except OSError:
+                pass
+            self.conn = None
+
+    def release_buffer(self):
+        if self.shm is not None:
+            self.shm.close()
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+            self.shm = None
+
+
+class InferenceClient:
+    """
+    Drop-in stand-in for the in-process model on API workers: exposes
+    `names` and `detect(image, confidence_threshold, rois, classes)`. Requests are spread
+    round-robin over the inference processes and fail over on errors.
+    """
+
+    def __init__(self, addresses, authkey=None):
+        self.channels = [InferenceChannel(address, authkey) for address in addresses]
+        self._next = itertools.cycle(self.channels)
+        self._next_lock = threading.Lock()
+
+    def _handshake_value(self, name, probe=False):
+        if not probe:
+            for channel in self.channels:
+                if getattr(channel, name) is not None:
+                    return getattr(channel, name)
+        # The handshake carries the class names and model identity
+        for channel in self.channels:
+            with channel.lock:
+                try:
+                    if not channel.alive():
+                        channel.connect()
+                    return getattr(channel, name)
+                except CONNECTION_ERRORS:
+                    channel.disconnect()
+        raise RuntimeError("Inference service unavailable")
+
+    @property
+    def names(self):
+        return self._handshake_value("names")
+
+    def is_available(self):
+        """Whether at least one inference process is reachable, without waiting on busy connections"""
+        now = time.time()
+        for channel in self.channels:
+            if channel.retry_at > now:
+                continue
+            if not channel.lock.acquire(blocking=False):
+                # Busy with a request; a hung process is restarted by the supervisor
+                if channel.conn is not None:
+                    return True
+                continue
+            try:
+                if not channel.alive():
+                    channel.connect()
+                return True
+            except CONNECTION_ERRORS:
+                channel.disconnect()
+                channel.retry_at = time.time() + FAILURE_BACKOFF
+            finally:
+                channel.lock.release()
+        return False
+
+    @property
+    def model_id(self):
+        """Identity of the weights the service runs, used to key cached results"""
+        # Only trust live connections: a restarted process may run new weights
+        return self._handshake_value("model_id", probe=True)
+
+    def detect(self, image, confidence_threshold=0.5, rois=None, classes=None, model_ids=None):
+        """
+        Detections for an image from the next available process. The
+        identity of the weights that served it is added to `model_ids`.
+        """
+        last_error = None
+        # Try every process once, then once more to ride out a restart
+        for attempt in range(2 * len(self.channels)):
+            with self._next_lock:
+                channel = next(self._next)
+            # Skip recently failed processes unless we are retrying everything
+            if channel.retry_at > time.time() and attempt < len(self.channels):
+                continue
+            with channel.lock:
+                try:
+                    result = channel.detect(image, confidence_threshold, rois, classes)
+                    if model_ids is not None:
+                        model_ids.add(channel.model_id)
+                    return result
+                except CONNECTION_ERRORS as e:
+                    print(f"Inference worker {channel.address} unavailable: {e}")
+                    channel.disconnect()
+                    channel.retry_at = time.time() + FAILURE_BACKOFF
+                    last_error = e
+            time.sleep(0.1)
+        raise RuntimeError(f"Inference service unavailable: {last_error}")
+
+    def close(self):
+        for channel in self.channels:
+            with channel.lock:
+                channel.disconnect()
+                channel.release_buffer()
+
+
+def parse_addresses(value):
+    addresses = []
+    for item in value.split(","):
+        item = item.strip()
+        if item:
+            host, _, port = item.rpartition(":")
+            addresses.append((host or "127.0.0.1", int(port)))
+    return addresses
+
+
+def client_from_env():
+    """InferenceClient for the addresses in INFERENCE_SERVICE, or None when running the model in-process"""
+    value = os.environ.get("INFERENCE_SERVICE")
+    if not value:
+        return None
+    return InferenceClient(parse_addresses(value))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shared YOLO inference service")
+    parser.add_argument("--model", default="best.pt", help="Path to the YOLO weights")
+    parser.add_argument("--workers", type=int, default=1, help="Number of inference processes")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765, help="Port of the first process, others use the following ports")
+    parser.add_argument("--threads", type=int, default=0, help="Torch threads per process (0 = torch default)")
+    args = parser.parse_args()
+
+    run_supervisor(args.model, args.workers, args.host, args.port, args.threads)
@@ -7,23 +7,52 @@ import numpy as np
 import tempfile
 import base64
 import uuid
-import torch
 from io import BytesIO
 from typing import List, Optional, Dict
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Query, Request, BackgroundTasks
+from starlette.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, Response
 from pydantic import BaseModel
-from PIL import Image, ImageDraw
-from ultralytics import YOLO
 import glob
 import os.path
 import time
-import imageio
 from datetime import datetime
 from pathlib import Path
+import math
 import shutil
+import threading
+import json
+from fastapi.encoders import jsonable_encoder
+from annotation import AnnotationRenderer, label_text
+from detector import detect_arrays, empty_detections, model_identity, safe_load_model
+from frame_gate import CHANGE_THRESHOLD, MAX_SKIPPED_FRAMES, ChangeGate
+from geo_index import MAX_ZOOM, GeoIndex, gps_from_exif, valid_position
+from inference_service import InferenceClient, client_from_env
+from payloads import (
+    ColumnarDetections,
+    check_response_format,
+    compact_response,
+    encode_json,
+    from_jsonable,
+)
+from storage import VideoStorage, content_hash
+from video_encoder import shutdown_encoder_pools
+from video_output import (
+    STREAMING_OUTPUT_FORMATS,
+    VideoStaticFiles,
+    discard_video,
+    ensure_poster,
+    get_video_writer,
+    is_partial,
+    new_video_target,
+    partial_marker_for,
+    poster_path_for,
+    resolve_video_path,
+    save_poster,
+    video_file_response,
+)
 
 # Initialize FastAPI app
 app = FastAPI(
@@ -44,42 +73,113 @@ app.add_middleware(
 # Create videos directory if it doesn't exist
 os.makedirs("videos", exist_ok=True)
 
+# Tracks processed videos for quotas, eviction and deduplication
+storage = VideoStorage("videos")
+
 # IMPORTANT: First mount /videos and other specific paths before the frontend route
-app.mount("/videos", StaticFiles(directory="videos"), name="videos")
+app.mount("/videos", VideoStaticFiles(directory="videos", on_access=storage.touch_path), name="videos")
+
+# /detect/multiple jobs by id, so their status can be polled
+jobs = {}
+jobs_lock = threading.Lock()
+
+# Seconds finished jobs are kept in memory (afterwards the storage index answers)
+JOB_RETENTION_SECONDS = 3600
+
+# Spatial index of geo-tagged detections for the map views
+geo_index = GeoIndex()
 
 # Define API routes BEFORE mounting the frontend static files
 @app.get("/api/health")
-async def health_check():
+def health_check():
     """Health check endpoint for monitoring"""
+    if isinstance(model, InferenceClient):
+        # The model lives in the shared inference service, report whether it can be reached
+        available = model.is_available()
+        return {"status": "healthy" if available else "degraded", "model_loaded": available}
     return {"status": "healthy", "model_loaded": model is not None}
 
 @app.get("/api/videos")
 def list_api_videos():
     """Return a list of processed videos for API consumers"""
     try:
+        # Served from the storage index instead of scanning the directory
         videos = []
-        if os.path.exists("videos"):
-            for file in os.listdir("videos"):
-                if file.endswith((".mp4", ".avi", ".mov")):
-                    video_path = os.path.join("videos", file)
-                    video_stats = os.stat(video_path)
-                    videos.append(VideoInfo(
-                        id=file,
-                        url=f"/videos/{file}",
-                        created_at=video_stats.st_ctime,
-                        file_size=video_stats.st_size
-                    ))
+        for video in storage.list_videos():
+            videos.append(VideoInfo(
+                id=video["filename"].split("/")[0],
+                url=video["url"],
+                created_at=video["created_at"],
+                file_size=video["size"],
+                poster_url=f"/api/poster/{video['video_id']}"
+            ))
         return videos
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error listing videos: {str(e)}")
 
-@app.get("/api/video/{video_name}")
-async def get_api_video(video_name: str):
-    """Get a specific video file through the API"""
-    video_path = os.path.join("videos", video_name)
-    if not os.path.exists(video_path):
+@app.get("/api/video/{video_name:path}")
+async def get_api_video(video_name: str, request: Request):
+    """Get a specific video file (or HLS playlist/segment) through the API"""
+    video_path = resolve_video_path(video_name)
+    if not os.path.isfile(video_path):
         raise HTTPException(status_code=404, detail="Video not found")
-    return FileResponse(video_path)
+    storage.touch_path(video_path)
+    return video_file_response(request, video_path)
+
+@app.get("/api/poster/{video_id}")
+async def get_api_poster(video_id: str, request: Request):
+    """Get the poster thumbnail of a video, generating and caching it on first use"""
+    video_id = os.path.basename(video_id)
+    generated = not os.path.exists(poster_path_for(video_id))
+    poster_path = ensure_poster(video_id)
+    if poster_path is None:
+        raise HTTPException(status_code=404, detail="Video not found")
+    if generated:
+        # Count the new poster towards the video's size for the quota
+        storage.refresh_size(video_id)
+    return video_file_response(request, poster_path)
+
+@app.get("/api/storage")
+def get_storage_stats():
+    """Usage statistics of the videos directory"""
+    return storage.stats()
+
+def check_bbox(min_lat, min_lng, max_lat, max_lng):
+    # Longitudes beyond +-180 and min_lng > max_lng (views crossing the
+    # antimeridian) are valid map viewports, the geo index normalizes them
+    if not all(math.isfinite(value) for value in (min_lat, min_lng, max_lat, max_lng)):
+        raise HTTPException(status_code=400, detail="Bounding box coordinates must be finite numbers")
+    if min_lat > max_lat:
+        raise HTTPException(status_code=400, detail="Bounding box min_lat is greater than max_lat")
+
+@app.get("/api/map/clusters")
+def get_map_clusters(
+    min_lat: float = -90,
+    min_lng: float = -180,
+    max_lat: float = 90,
+    max_lng: float = 180,
+    zoom: int = Query(3, ge=0, le=MAX_ZOOM),
+    start: Optional[float] = None,
+    end: Optional[float] = None
+):
+    """Detections in a bounding box / time range (unix seconds), clustered for the map zoom level"""
+    check_bbox(min_lat, min_lng, max_lat, max_lng)
+    return geo_index.clusters(min_lat, min_lng, max_lat, max_lng, zoom, start, end)
+
+@app.get("/api/map/hotspots")
+def get_map_hotspots(
+    min_lat: float = -90,
+    min_lng: float = -180,
+    max_lat: float = 90,
+    max_lng: float = 180,
+    zoom: int = Query(3, ge=0, le=MAX_ZOOM),
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+    limit: int = Query(10, ge=1)
+):
+    """Most polluted areas in a bounding box with their pollution level"""
+    check_bbox(min_lat, min_lng, max_lat, max_lng)
+    return geo_index.hotspots(min_lat, min_lng, max_lat, max_lng, zoom, start, end, limit)
 
 # API-specific root endpoint
 @app.get("/api")
@@ -89,7 +189,11 @@ def read_api_root():
 @app.post("/detect/image")
 async def detect_image(
     file: UploadFile = File(...),
-    confidence_threshold: float = Form(0.5)
+    confidence_threshold: float = Form(0.5),
+    latitude: Optional[float] = Form(None),
+    longitude: Optional[float] = Form(None),
+    rois: Optional[str] = Form(None),
+    classes: Optional[str] = Form(None)
 ):
     # Check if the uploaded file is an image
     if not file.content_type.startswith("image/"):
@@ -103,8 +207,16 @@ async def detect_image(
     if img is None:
         raise HTTPException(status_code=400, detail="Could not read the image")
     
+    check_position(latitude, longitude)
+    roi_boxes = parse_rois(rois)
+    class_filter = await run_in_threadpool(parse_classes, classes)
+    
     # Process the image
-    processed_img, detections = process_image(img, confidence_threshold)
+    processed_img, detections = process_image(img, confidence_threshold, rois=roi_boxes, classes=class_filter)
+    
+    # Add the detections to the map when the image position is known
+    position = get_position(contents, latitude, longitude)
+    index_detections(position, geo_detections(detections))
     
     # Encode the processed image to base64
     encoded_img = encode_image_to_base64(processed_img)
@@ -113,63 +225,146 @@ async def detect_image(
     return ImageResponse(
         processed_image=encoded_img,
         detections=detections,
-        detection_count=len(detections)
+        detection_count=len(detections),
+        latitude=position[0] if position else None,
+        longitude=position[1] if position else None
     )
 
 @app.post("/detect/multiple")
 async def detect_multiple_images(
+    background_tasks: BackgroundTasks,
     files: List[UploadFile] = File(...),
     confidence_threshold: float = Form(0.5),
-    fps: int = Form(5)
+    fps: int = Form(5),
+    output_format: str = Form("mp4"),
+    response_format: str = Form("verbose"),
+    latitude: Optional[float] = Form(None),
+    longitude: Optional[float] = Form(None),
+    change_threshold: float = Form(CHANGE_THRESHOLD),
+    max_skipped_frames: int = Form(MAX_SKIPPED_FRAMES),
+    rois: Optional[str] = Form(None),
+    classes: Optional[str] = Form(None)
 ):
     # Check if there are any files
     if not files:
         raise HTTPException(status_code=400, detail="No files provided")
+    check_response_format(response_format)
+    check_position(latitude, longitude)
+    roi_boxes = parse_rois(rois)
+    class_filter = await run_in_threadpool(parse_classes, classes)
+    verbose = response_format == "verbose"
     
-    # Process all images
-    frames = []
-    all_detections = []  # Store detections for each frame
-    total_detections = 0
-    
+    # Read all uploads up front so identical submissions can be deduplicated
+    uploads = []
     for file in files:
         if not file.content_type.startswith("image/"):
             continue
-            
-        contents = await file.read()
-        np_arr = np.frombuffer(contents, np.uint8)
-        img = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
-        
-        if img is None:
-            continue
-            
-        processed_img, detections = process_image(img, confidence_threshold)
-        frames.append(processed_img)
-        all_detections.append(detections)  # Add this frame's detections to the list
-        total_detections += len(detections)
-    
-    if not frames:
-        raise HTTPException(status_code=400, detail="No valid images were processed")
+        uploads.append(await file.read())
     
-    # Generate a video file with a unique name
-    video_filename = f"{uuid.uuid4()}.mp4"
-    video_path = os.path.join("videos", video_filename)
+    # Results are only reusable for the same weights. Looking up the inference
+    # service's weights may connect to it, so this runs off the event loop
+    identity = await run_in_threadpool(current_model_id)
+    submission_hash = content_hash(
+        uploads,
+        model=identity,
+        confidence_threshold=confidence_threshold,
+        fps=fps,
+        output_format=output_format,
+        verbose=verbose,
+        latitude=latitude,
+        longitude=longitude,
+        change_threshold=change_threshold,
+        max_skipped_frames=max_skipped_frames,
+        rois=roi_boxes,
+        classes=class_filter
+    )
+    cached = storage.lookup(submission_hash) if identity is not None else None
+    if cached is not None:
+        cached_id, cached_response = cached
+        if output_format in STREAMING_OUTPUT_FORMATS:
+            # Same 202 job shape as a fresh submission, the status URL
+            # answers with the stored response of the existing video
+            summary = json.loads(cached_response)
+            job = {
+                "job_id": cached_id,
+                "status": "done",
+                "video_url": summary["video_url"],
+                "frames_processed": summary["frame_count"],
+                "frame_total": summary["frame_count"],
+            }
+            status = job_status(job)
+            if not verbose:
+                status["status_url"] += f"?response_format={response_format}"
+            return JSONResponse(status_code=202, content=status)
+        return job_response(stored_job(cached_response, response_format))
     
-    writer = imageio.get_writer(video_path, fps=fps)
+    # Generate a video target with a unique name
+    video_id = str(uuid.uuid4())
+    video_path, video_url = new_video_target(video_id, output_format)
     
-    for frame in frames:
-        writer.append_data(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+    job = {
+        "job_id": video_id,
+        "status": "running",
+        "video_path": video_path,
+        "video_url": video_url,
+        "uploads": uploads,
+        "frames_processed": 0,
+        "frame_total": len(uploads),
+        "confidence_threshold": confidence_threshold,
+        "fps": fps,
+        "output_format": output_format,
+        "response_format": response_format,
+        "latitude": latitude,
+        "longitude": longitude,
+        # Near-identical consecutive frames reuse the previous frame's detections
+        "gate": ChangeGate(change_threshold, max_skipped_frames),
+        "rois": roi_boxes,
+        "classes": class_filter,
+        "submission_hash": submission_hash,
+        "model_id": identity,
+    }
     
-    writer.close()
+    if output_format in STREAMING_OUTPUT_FORMATS:
+        # Playable while being written: hand out the URLs right away and
+        # process in the background, clients poll the status URL for the result
+        add_job(job)
+        background_tasks.add_task(run_detection_job_in_background, job)
+        return JSONResponse(status_code=202, content=job_status(job))
     
-    # Return the URL that can be accessed through the web
-    video_url = f"/videos/{video_filename}"
+    # Decoding, inference and encoding must not block the event loop
+    await run_in_threadpool(run_detection_job, job)
+    return job_response(job)
+
+@app.get("/api/jobs/{job_id}")
+def get_job(job_id: str, response_format: Optional[str] = None):
+    """
+    Status of a background /detect/multiple job: 202 while it runs, the
+    regular /detect/multiple response once it is done.
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        # Finished by another worker or before a restart: the storage index has the response
+        cached = storage.response_for(job_id)
+        if cached is None:
+            for candidate in (os.path.join("videos", f"{job_id}.mp4"), os.path.join("videos", job_id, "index.m3u8")):
+                if is_partial(candidate):
+                    return JSONResponse(status_code=202, content={"job_id": job_id, "status": "running"})
+            raise HTTPException(status_code=404, detail="Job not found")
+        if response_format is None:
+            # Only compact payloads have columns, detections never use that key
+            response_format = "compact" if '"columns":' in cached else "verbose"
+        check_response_format(response_format)
+        job = stored_job(cached, response_format)
+    elif response_format is not None and job["status"] == "done":
+        # Deduplicated submissions share the job but may ask for another format
+        check_response_format(response_format)
+        job = {**job, "response_format": response_format}
     
-    return MultipleImagesResponse(
-        video_url=video_url,
-        detection_count=total_detections,
-        frame_count=len(frames),
-        detections=all_detections  # Include detections per frame in the response
-    )
+    if job["status"] == "running":
+        return JSONResponse(status_code=202, content=job_status(job))
+    if job["status"] == "failed":
+        return JSONResponse(status_code=job["error_status"], content=job_status(job))
+    return job_response(job)
 
 # IMPORTANT: Mount React frontend assets - these are needed for the React app
 app.mount("/assets", StaticFiles(directory="dist/assets"), name="assets")
@@ -186,6 +381,23 @@ hazardous_trash = {"trash_metal", "trash_rubber", "trash_fishing_gear", "trash_p
 non_hazardous_trash = {"trash_etc", "trash_fabric", "trash_paper", "trash_wood"}
 aquatic_life = {"animal_fish", "animal_starfish", "animal_shells", "animal_crab", "animal_eel", "animal_etc", "plant"}
 
+# Box colours per category (BGR)
+CATEGORY_COLORS = {
+    "hazardous_trash": (0, 0, 255),  # Red
+    "non_hazardous_trash": (0, 165, 255),  # Orange
+    "aquatic_life": (0, 255, 0),  # Green
+}
+DEFAULT_COLOR = (255, 255, 255)  # White
+
+# Class names per category, for filtering requests by category
+CATEGORY_CLASSES = {
+    "hazardous_trash": hazardous_trash,
+    "non_hazardous_trash": non_hazardous_trash,
+    "aquatic_life": aquatic_life,
+}
+
+renderer = AnnotationRenderer()
+
 # Response models
 class Detection(BaseModel):
     class_name: str
@@ -201,70 +413,67 @@ class ImageResponse(BaseModel):
     processed_image: str  # Base64 encoded image
     detections: List[Detection]
     detection_count: int
+    latitude: Optional[float] = None  # Position the detections were indexed at
+    longitude: Optional[float] = None
 
 class MultipleImagesResponse(BaseModel):
     video_url: str  # URL to processed video
     detection_count: int
     frame_count: int
     detections: List[List[Detection]]  # List of lists of detections
+    poster_url: Optional[str] = None  # URL to the cached poster thumbnail
+    inferred_frames: Optional[int] = None  # Frames that went through the model
+    skipped_frames: Optional[int] = None  # Unchanged frames that reused the previous detections
 
 class VideoInfo(BaseModel):
     id: str
     url: str
     created_at: float
     file_size: int  # Size in bytes
+    poster_url: Optional[str] = None
 
 # Global variable for our model
 model = None
-
-# Patch PyTorch load function to handle newer security restrictions
-def safe_load_model(model_path):
-    try:
-        # Option 1: Try to load with regular settings (no verbose parameter)
-        return YOLO(model_path)
-    except TypeError as e:
-        if "unexpected keyword argument 'verbose'" in str(e):
-            print("Caught verbose parameter error, trying without it")
-            # The verbose parameter is not supported in this version
-            return YOLO(model_path)
-        else:
-            print(f"Standard loading failed with TypeError: {e}")
-            # Option 2: If that fails, monkey patch torch.load
-            original_torch_load = torch.load
-            
-            def patched_torch_load(f, *args, **kwargs):
-                kwargs['weights_only'] = False
-                return original_torch_load(f, *args, **kwargs)
-            
-            # Apply the monkey patch
-            torch.load = patched_torch_load
-            
-            try:
-                # Try loading with the patched function
-                return YOLO(model_path)
-            finally:
-                # Restore original function regardless of outcome
-                torch.load = original_torch_load
-    except Exception as e:
-        print(f"Model loading failed with error: {e}")
-        return None
+# Local YOLO models are not thread-safe; jobs run in worker threads
+model_lock = threading.Lock()
+# Identity of the local weights (see model_identity)
+model_id = None
 
 @app.on_event("startup")
 async def startup_event():
-    global model
-    try:
-        # Try to load with our safe loader function
-        model_path = "best.pt"
-        if not os.path.exists(model_path):
-            raise FileNotFoundError(f"Model file {model_path} not found")
-        
-        model = safe_load_model(model_path)
-        print("Model loaded successfully")
-    except Exception as e:
-        print(f"Error loading model: {e}")
-        # Provide a detailed error message, but don't fail startup
-        # This allows the API to start even if model loading fails
-        # Users will get errors when trying to use detection endpoints
+    global model, model_id
+    
+    # Multi-worker mode: a shared inference service owns the model
+    inference_client = client_from_env()
+    if inference_client is not None:
+        model = inference_client
+        print(f"Using shared inference service at {os.environ['INFERENCE_SERVICE']}")
+    else:
+        try:
+            # Try to load with our safe loader function
+            model_path = "best.pt"
+            if not os.path.exists(model_path):
+                raise FileNotFoundError(f"Model file {model_path} not found")
+            
+            model = safe_load_model(model_path)
+            model_id = model_identity(model_path)
+            print("Model loaded successfully")
+        except Exception as e:
+            print(f"Error loading model: {e}")
+            # Provide a detailed error message, but don't fail startup
+            # This allows the API to start even if model loading fails
+            # Users will get errors when trying to use detection endpoints
+    
+    # Pick up videos created before the storage index existed and start evicting
+    storage.rescan()
+    storage.start_sweeper()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    storage.stop_sweeper()
+    shutdown_encoder_pools()
+    if isinstance(model, InferenceClient):
+        model.close()
 
 def get_location(x1, y1, x2, y2, img_width, img_height):
     center_x, center_y = (x1 + x2) // 2, (y1 + y2) // 2
@@ -282,7 +491,260 @@ def get_category(class_name):
     else:
         return "unknown"
 
-def process_image(image, confidence_threshold=0.5):
+def current_model_id():
+    """Identity of the weights detections come from, None when no model is available"""
+    if model is None:
+        return None
+    if isinstance(model, InferenceClient):
+        try:
+            return model.model_id
+        except RuntimeError as e:
+            print(f"Could not identify the inference service model: {e}")
+            return None
+    return model_id
+
+def check_position(latitude, longitude):
+    if (latitude is not None or longitude is not None) and not valid_position(latitude, longitude):
+        raise HTTPException(status_code=400, detail="latitude and longitude must both be given and valid")
+
+def get_position(contents, latitude=None, longitude=None):
+    """Position of an upload: explicit coordinates first, then the image's EXIF GPS"""
+    if latitude is not None:
+        return latitude, longitude
+    return gps_from_exif(contents)
+
+def geo_detections(detections):
+    """(class_name, category, confidence) of Detection objects, as stored by the geo index"""
+    return [(d.class_name, d.category, d.confidence) for d in detections]
+
+def geo_detection_arrays(confidences, class_ids):
+    names = [model.names[c] for c in class_ids.tolist()]
+    return [(name, get_category(name), conf) for name, conf in zip(names, confidences.tolist())]
+
+def index_detections(position, detections):
+    if position is None or not detections:
+        return
+    geo_index.add(*position, detections)
+
+def parse_rois(value):
+    """Regions of interest from a JSON list of [x1, y1, x2, y2] boxes, None for the whole image"""
+    if not value:
+        return None
+    try:
+        rois = [tuple(int(v) for v in roi) for roi in json.loads(value)]
+    except (ValueError, TypeError, OverflowError):
+        # OverflowError: Infinity, -Infinity or numbers too large for a float
+        rois = None
+    if not rois or any(len(roi) != 4 for roi in rois):
+        raise HTTPException(status_code=400, detail="rois must be a JSON list of [x1, y1, x2, y2] boxes")
+    return rois
+
+def parse_classes(value):
+    """Class ids for comma-separated class and/or category names, None for all classes"""
+    if not value or model is None:
+        return None
+    try:
+        # Blocks on the inference service handshake, call it off the event loop
+        names = model.names
+    except RuntimeError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    ids_by_name = {name: class_id for class_id, name in names.items()}
+    class_ids = set()
+    for name in value.split(","):
+        name = name.strip()
+        if not name:
+            continue
+        if name in CATEGORY_CLASSES:
+            class_ids.update(ids_by_name[n] for n in CATEGORY_CLASSES[name] if n in ids_by_name)
+        elif name in ids_by_name:
+            class_ids.add(ids_by_name[name])
+        else:
+            raise HTTPException(status_code=400, detail=f"Unknown class or category '{name}'")
+    return sorted(class_ids)
+
+def add_job(job):
+    now = time.time()
+    with jobs_lock:
+        # Finished jobs only need to stay around for clients to pick up their result
+        for job_id, other in list(jobs.items()):
+            if other.get("finished_at") and now - other["finished_at"] > JOB_RETENTION_SECONDS:
+                del jobs[job_id]
+        jobs[job["job_id"]] = job
+
+def job_status(job):
+    status = {
+        "job_id": job["job_id"],
+        "status": job["status"],
+        "video_url": job["video_url"],
+        "poster_url": f"/api/poster/{job['job_id']}",
+        "status_url": f"/api/jobs/{job['job_id']}",
+        "frames_processed": job["frames_processed"],
+        "frame_total": job["frame_total"],
+    }
+    if job["status"] == "failed":
+        status["error"] = job["error"]
+    return status
+
+def stored_job(response, response_format):
+    """A finished job for a response (JSON) from the storage index"""
+    job = {"status": "done", "response_format": response_format, "body": response.encode()}
+    # Compact JSON is served as stored, only other formats need it decoded
+    if response_format == "verbose":
+        job["result"] = json.loads(response)
+    elif response_format == "msgpack":
+        job["result"] = from_jsonable(json.loads(response))
+    return job
+
+def job_response(job):
+    """
+    The /detect/multiple response of a finished job. Compact results are
+    kept as numpy columns plus their JSON encoding in job["body"], which is
+    served (and cached) as is instead of being encoded again.
+    """
+    if job["response_format"] == "verbose":
+        return MultipleImagesResponse(**job["result"])
+    if job["response_format"] == "compact":
+        return Response(content=job["body"], media_type="application/json")
+    return compact_response(job["result"], job["response_format"])
+
+def run_detection_job_in_background(job):
+    try:
+        run_detection_job(job)
+    except Exception as e:
+        print(f"Detection job {job['job_id']} failed: {e}")
+        job["error"] = e.detail if isinstance(e, HTTPException) else str(e)
+        job["error_status"] = e.status_code if isinstance(e, HTTPException) else 500
+        job["status"] = "failed"
+        job["finished_at"] = time.time()
+
+def run_detection_job(job):
+    """
+    Process the uploaded frames of a /detect/multiple job, encoding each
+    frame as soon as it is ready so fragmented/HLS outputs become playable
+    while the job is still running. Stores the response in job["result"].
+    """
+    video_id, video_path = job["job_id"], job["video_path"]
+    verbose = job["response_format"] == "verbose"
+    gate = job["gate"]
+    
+    writer = None
+    frame_count = 0
+    all_detections = []  # Store detections for each frame
+    columns = ColumnarDetections()  # Same, as typed columns for compact responses
+    total_detections = 0
+    inference_errors = []  # Frames whose inference failed
+    # Consecutive frames at one position mostly show the same objects, the
+    # frame with the most detections stands for the run on the map
+    run_position, run_detections = None, []
+    served_by = set()  # Identities of the weights that ran inference
+    
+    # Served with no-cache while the file is still growing
+    marker = partial_marker_for(video_path)
+    open(marker, "w").close()
+    try:
+        for contents in job["uploads"]:
+            np_arr = np.frombuffer(contents, np.uint8)
+            img = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
+            job["frames_processed"] += 1
+        
+            if img is None:
+                continue
+            
+            if verbose:
+                processed_img, detections = process_image(
+                    img, job["confidence_threshold"], gate, job["rois"], job["classes"], inference_errors, served_by
+                )
+                all_detections.append(detections)  # Add this frame's detections to the list
+            else:
+                processed_img, (boxes, confidences, class_ids) = process_image_arrays(
+                    img, job["confidence_threshold"], gate, job["rois"], job["classes"], inference_errors, served_by
+                )
+                columns.add(frame_count, boxes, confidences, class_ids)
+                detections = boxes
+            total_detections += len(detections)
+        
+            # Frames of a moving camera can carry their own GPS position
+            position = get_position(contents, job["latitude"], job["longitude"])
+            if position != run_position:
+                index_detections(run_position, run_detections)
+                run_position, run_detections = position, []
+            if position is not None and len(detections) > len(run_detections):
+                run_detections = geo_detections(detections) if verbose else geo_detection_arrays(confidences, class_ids)
+        
+            if writer is None:
+                writer = get_video_writer(video_path, job["fps"], job["output_format"])
+                save_poster(video_id, processed_img)
+            writer.append_data(cv2.cvtColor(processed_img, cv2.COLOR_BGR2RGB))
+            frame_count += 1
+        
+        if writer is None:
+            raise HTTPException(status_code=400, detail="No valid images were processed")
+        
+        writer.close()
+        index_detections(run_position, run_detections)
+    except BaseException:
+        # Leave nothing behind the storage index does not know about
+        discard_video(video_id, video_path, writer)
+        raise
+    finally:
+        if os.path.exists(marker):
+            os.remove(marker)
+        del job["uploads"]  # Free the frames, the job may be kept for a while
+    
+    print(f"Change gating: {gate.inferred} frames inferred, {gate.skipped} skipped")
+    
+    if verbose:
+        response = MultipleImagesResponse(
+            video_url=job["video_url"],
+            detection_count=total_detections,
+            frame_count=frame_count,
+            detections=all_detections,  # Include detections per frame in the response
+            poster_url=f"/api/poster/{video_id}",
+            **gate.stats()
+        )
+        result = jsonable_encoder(response)
+    else:
+        class_names = [model.names[i] for i in sorted(model.names)] if model is not None else []
+        result = {
+            "video_url": job["video_url"],
+            "detection_count": total_detections,
+            "frame_count": frame_count,
+            "poster_url": f"/api/poster/{video_id}",
+            "classes": class_names,
+            "categories": [get_category(name) for name in class_names],
+            "columns": columns.columns(),
+            **gate.stats()
+        }
+        job["body"] = encode_json(result)
+    
+    # Demo-mode output (no model) and failed runs must not be served for later
+    # submissions, nor results of other weights than the hash was computed for
+    # (the inference service may have been restarted with new weights meanwhile)
+    reusable = job["model_id"] is not None and not inference_errors and served_by == {job["model_id"]}
+    storage.register(
+        video_id,
+        os.path.relpath(video_path, "videos"),
+        job["video_url"],
+        content_hash=job["submission_hash"] if reusable else None,
+        response=json.dumps(result) if verbose else job["body"].decode()
+    )
+    
+    job["result"] = result
+    job["status"] = "done"
+    job["finished_at"] = time.time()
+    return result
+
+def process_image_arrays(image, confidence_threshold=0.5, gate=None, rois=None, classes=None, errors=None, model_ids=None):
+    """
+    Run the model on an image and draw the results on it.
+    Returns the image and (boxes Nx4, confidences N, class_ids N) numpy arrays,
+    without building per-detection objects.
+    With a ChangeGate, frames that barely differ from the last inferred one
+    reuse its detections instead of running the model. `rois` and `classes`
+    (class ids) restrict inference to regions of the image and to classes.
+    Inference failures are drawn on the image and appended to `errors`, the
+    identity of the weights that ran inference is added to `model_ids`.
+    """
     global model
     
     # Debug protection in case model failed to load
@@ -302,61 +764,32 @@ def process_image(image, confidence_threshold=0.5):
                 (0, 0, 255), 
                 2
             )
-        return processed_img, []
+        return processed_img, empty_detections()
     
     try:    
-        results = model(image)
-        detections = []
-        img_height, img_width = image.shape[:2]
+        if gate is not None and not gate.should_infer(image):
+            boxes, confidences, class_ids = gate.result
+        elif isinstance(model, InferenceClient):
+            # Frames go to the shared inference service through shared memory
+            boxes, confidences, class_ids = model.detect(image, confidence_threshold, rois, classes, model_ids)
+        else:
+            with model_lock:
+                boxes, confidences, class_ids = detect_arrays(model, image, confidence_threshold, rois, classes)
+            if model_ids is not None:
+                model_ids.add(model_id)
+        if gate is not None:
+            gate.result = (boxes, confidences, class_ids)
         
-        for r in results:
-            for box in r.boxes:
-                try:
-                    conf = box.conf[0].item()
-                    if conf < confidence_threshold:
-                        continue
-                        
-                    class_id = int(box.cls[0])
-                    class_name = model.names[class_id]
-                    x1, y1, x2, y2 = map(int, box.xyxy[0])
-                    
-                    # Determine the category and location
-                    category = get_category(class_name)
-                    location = get_location(x1, y1, x2, y2, img_width, img_height)
-                    
-                    # Draw on image with category-specific colors
-                    if category == 'hazardous_trash':
-                        color = (0, 0, 255)  # Red in BGR
-                    elif category == 'non_hazardous_trash':
-                        color = (0, 165, 255)  # Orange in BGR
-                    elif category == 'aquatic_life':
-                        color = (0, 255, 0)  # Green in BGR
-                    else:
-                        color = (255, 255, 255)  # White in BGR
-                        
-                    cv2.rectangle(image, (x1, y1), (x2, y2), color, 2)
-                    text = f"{class_name} ({conf:.2f})"
-                    cv2.putText(image, text, (x1, y1 - 5), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 2)
-                    
-                    # Print debug info for each detection
-                    print(f"Detection: {class_name}, category: {category}, confidence: {conf:.2f}")
-                    
-                    # Add to detections
-                    detections.append(Detection(
-                        class_name=class_name,
-                        confidence=conf,
-                        x1=x1, y1=y1, x2=x2, y2=y2,
-                        category=category,
-                        location=location
-                    ))
-                except Exception as e:
-                    print(f"Error processing detection: {e}")
-                    continue
+        # Draw all boxes in one pass with category-specific colors
+        labels = [label_text(model.names[c], conf) for c, conf in zip(class_ids.tolist(), confidences.tolist())]
+        colors = [CATEGORY_COLORS.get(get_category(model.names[c]), DEFAULT_COLOR) for c in class_ids.tolist()]
+        renderer.draw(image, boxes.tolist(), labels, colors)
         
-        print(f"Total detections found: {len(detections)}")
-        return image, detections
+        return image, (boxes, confidences, class_ids)
     except Exception as e:
         print(f"Error in process_image: {e}")
+        if errors is not None:
+            errors.append(str(e))
         # Return original image with error message
         if isinstance(image, np.ndarray):
             height, width = image.shape[:2]
@@ -369,22 +802,57 @@ def process_image(image, confidence_threshold=0.5):
                 (0, 0, 255), 
                 2
             )
-        return image, []
+        return image, empty_detections()
+
+def process_image(image, confidence_threshold=0.5, gate=None, rois=None, classes=None, errors=None, model_ids=None):
+    image, (boxes, confidences, class_ids) = process_image_arrays(
+        image, confidence_threshold, gate, rois, classes, errors, model_ids
+    )
+    detections = []
+    img_height, img_width = image.shape[:2]
+    
+    for (x1, y1, x2, y2), conf, class_id in zip(boxes.tolist(), confidences.tolist(), class_ids.tolist()):
+        try:
+            class_name = model.names[class_id]
+            
+            # Determine the category and location
+            category = get_category(class_name)
+            location = get_location(x1, y1, x2, y2, img_width, img_height)
+            
+            # Print debug info for each detection
+            print(f"Detection: {class_name}, category: {category}, confidence: {conf:.2f}")
+            
+            # Add to detections
+            detections.append(Detection(
+                class_name=class_name,
+                confidence=conf,
+                x1=x1, y1=y1, x2=x2, y2=y2,
+                category=category,
+                location=location
+            ))
+        except Exception as e:
+            print(f"Error processing detection: {e}")
+            continue
+    
+    print(f"Total detections found: {len(detections)}")
+    return image, detections
 
 def encode_image_to_base64(image):
-    # Convert OpenCV image to PIL Image
     if isinstance(image, np.ndarray):
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        pil_image = Image.fromarray(image)
+        # Encode the BGR frame directly, no colour conversion or PIL round trip
+        # (quality 75 matches PIL's JPEG default)
+        ok, buffer = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, 75])
+        if not ok:
+            raise ValueError("Could not encode image")
+        data = buffer.tobytes()
     else:
-        pil_image = image
-    
-    # Save to buffer
-    buffer = BytesIO()
-    pil_image.save(buffer, format="JPEG")
+        # Save PIL images to buffer
+        buffer = BytesIO()
+        image.save(buffer, format="JPEG")
+        data = buffer.getvalue()
     
     # Encode to base64
-    img_str = base64.b64encode(buffer.getvalue()).decode('utf-8')
+    img_str = base64.b64encode(data).decode('utf-8')
     return f"data:image/jpeg;base64,{img_str}"
 
 if __name__ == "__main__":
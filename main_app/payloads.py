@@ -0,0 +1,131 @@
+"""
+Compact, columnar detection payloads for /detect/multiple.
+
+Instead of one object per detection (repeating field names, class and
+category strings), detections of all frames are sent as parallel typed
+columns plus a class dictionary sent once:
+
+    {
+      "video_url": ..., "detection_count": ..., "frame_count": ..., "poster_url": ...,
+      "classes": ["animal_crab", ...],               # index = class id
+      "categories": ["aquatic_life", ...],           # category of each class
+      "columns": {
+        "frame": [...], "class_id": [...], "confidence": [...],
+        "x1": [...], "y1": [...], "x2": [...], "y2": [...]
+      }
+    }
+
+Formats:
+
+- compact: JSON, serialized with orjson when it is installed
+- msgpack: MessagePack, columns as raw little-endian typed arrays (bytes)
+  described by "dtypes", e.g. `new Float32Array(columns.confidence)`
+
+The verbose List[List[Detection]] response remains the default.
+"""
+import json
+
+import numpy as np
+from fastapi import HTTPException
+from fastapi.responses import Response
+
+try:
+    import orjson
+except ImportError:  # Optional, falls back to the standard library encoder
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # Optional, only needed for response_format=msgpack
+    msgpack = None
+
+RESPONSE_FORMATS = ("verbose", "compact", "msgpack")
+
+COLUMN_DTYPES = {
+    "frame": "<u4",
+    "class_id": "<u2",
+    "confidence": "<f4",
+    "x1": "<i4",
+    "y1": "<i4",
+    "x2": "<i4",
+    "y2": "<i4",
+}
+
+
+def check_response_format(response_format):
+    if response_format not in RESPONSE_FORMATS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unsupported response_format '{response_format}', expected one of {', '.join(RESPONSE_FORMATS)}"
+        )
+    if response_format == "msgpack" and msgpack is None:
+        raise HTTPException(status_code=400, detail="response_format 'msgpack' requires the msgpack package")
+
+
+class ColumnarDetections:
+    """Accumulates per-frame detection arrays into columns"""
+
+    def __init__(self):
+        self._frames = []
+        self._boxes = []
+        self._confidences = []
+        self._class_ids = []
+
+    def add(self, frame_index, boxes, confidences, class_ids):
+        self._frames.append(np.full(len(boxes), frame_index, dtype=COLUMN_DTYPES["frame"]))
+        self._boxes.append(boxes)
+        self._confidences.append(confidences)
+        self._class_ids.append(class_ids)
+
+    def columns(self):
+        if not self._frames:
+            return {name: np.zeros(0, dtype=dtype) for name, dtype in COLUMN_DTYPES.items()}
+        boxes = np.concatenate(self._boxes).reshape(-1, 4)
+        return {
+            "frame": np.concatenate(self._frames),
+            "class_id": np.concatenate(self._class_ids).astype(COLUMN_DTYPES["class_id"]),
+            "confidence": np.concatenate(self._confidences).astype(COLUMN_DTYPES["confidence"]),
+            "x1": boxes[:, 0].astype(COLUMN_DTYPES["x1"]),
+            "y1": boxes[:, 1].astype(COLUMN_DTYPES["y1"]),
+            "x2": boxes[:, 2].astype(COLUMN_DTYPES["x2"]),
+            "y2": boxes[:, 3].astype(COLUMN_DTYPES["y2"]),
+        }
+
+
+def to_jsonable(payload):
+    """Payload with columns as plain lists, e.g. for caching in the storage index"""
+    columns = {name: np.asarray(values).tolist() for name, values in payload["columns"].items()}
+    # float32 -> float widening would otherwise print as 0.699999988079071
+    columns["confidence"] = np.round(np.asarray(payload["columns"]["confidence"], dtype=np.float64), 6).tolist()
+    return {**payload, "columns": columns}
+
+
+def from_jsonable(payload):
+    return {
+        **payload,
+        "columns": {
+            name: np.asarray(values, dtype=COLUMN_DTYPES[name]) for name, values in payload["columns"].items()
+        },
+    }
+
+
+def encode_json(payload):
+    """JSON body of a compact payload, serialized straight from the numpy columns with orjson"""
+    if orjson is not None:
+        return orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(to_jsonable(payload), separators=(",", ":")).encode()
+
+
+def compact_response(payload, response_format):
+    """Serialize a compact payload (columns as numpy arrays) in the requested format"""
+    if response_format == "msgpack":
+        body = msgpack.packb({
+            **payload,
+            "columns": {
+                name: np.ascontiguousarray(values, dtype=COLUMN_DTYPES[name]).tobytes()
+                for name, values in payload["columns"].items()
+            },
+            "dtypes": COLUMN_DTYPES,
+        })
+        return Response(content=body, media_type="application/msgpack")
+    return Response(content=encode_json(payload), media_type="application/json")
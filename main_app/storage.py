@@ -0,0 +1,293 @@
+"""
+Storage lifecycle management for the videos directory.
+
+Every processed video is registered in a small SQLite index stored next to
+the videos. The index tracks size, creation and last access time and the
+content hash of the submission that produced the video, which allows:
+
+- deduplication: identical submissions return the existing video
+- eviction: a background sweeper removes videos past the retention age and
+  evicts least recently accessed videos while the directory is over quota
+- cheap listing and usage statistics without scanning the directory
+
+Configuration (environment variables, 0 disables the limit):
+
+    VIDEO_STORAGE_QUOTA_BYTES  default 10 GiB
+    VIDEO_RETENTION_SECONDS    default 30 days, measured from last access
+    VIDEO_SWEEP_INTERVAL       seconds between sweeps, default 300
+"""
+import os
+import time
+import json
+import shutil
+import sqlite3
+import hashlib
+import threading
+
+DEFAULT_QUOTA_BYTES = int(os.environ.get("VIDEO_STORAGE_QUOTA_BYTES", str(10 * 1024 ** 3)))
+DEFAULT_RETENTION_SECONDS = int(os.environ.get("VIDEO_RETENTION_SECONDS", str(30 * 24 * 3600)))
+DEFAULT_SWEEP_INTERVAL = int(os.environ.get("VIDEO_SWEEP_INTERVAL", "300"))
+
+INDEX_FILENAME = ".storage.db"
+
+# Access times only need to be roughly right for LRU eviction, so repeated
+# hits (e.g. every HLS segment of one video) are written at most this often
+TOUCH_RESOLUTION_SECONDS = 60
+
+# Files picked up by rescan() when adopting videos created outside the index
+VIDEO_EXTENSIONS = (".mp4", ".avi", ".mov")
+POSTER_EXTENSION = ".jpg"
+
+
+def content_hash(file_contents, **params):
+    """Hash the input frames (in order) together with the processing parameters"""
+    digest = hashlib.sha256()
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    for contents in file_contents:
+        # Length prefix so that frame boundaries are part of the hash
+        digest.update(len(contents).to_bytes(8, "little"))
+        digest.update(contents)
+    return digest.hexdigest()
+
+
+def path_size(path):
+    if os.path.isdir(path):
+        return sum(
+            os.path.getsize(os.path.join(dirpath, name))
+            for dirpath, _, filenames in os.walk(path)
+            for name in filenames
+        )
+    return os.path.getsize(path)
+
+
+def paths_size(paths):
+    return sum(path_size(path) for path in paths if os.path.exists(path))
+
+
+class VideoStorage:
+    def __init__(self, root="videos", quota_bytes=DEFAULT_QUOTA_BYTES,
+                 retention_seconds=DEFAULT_RETENTION_SECONDS, sweep_interval=DEFAULT_SWEEP_INTERVAL):
+        self.root = root
+        self.quota_bytes = quota_bytes
+        self.retention_seconds = retention_seconds
+        self.sweep_interval = sweep_interval
+
+        self.evicted_count = 0
+        self.dedup_hits = 0
+        self.last_sweep = None
+
+        self._last_touch = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        os.makedirs(root, exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(root, INDEX_FILENAME), check_same_thread=False)
+        # WAL lets several API workers read the index while one of them writes
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS videos (
+                video_id TEXT PRIMARY KEY,
+                filename TEXT NOT NULL,
+                url TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL,
+                content_hash TEXT,
+                response TEXT
+            )
+        """)
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_videos_hash ON videos(content_hash)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_videos_access ON videos(last_access)")
+        self._db.commit()
+
+    # Paths -----------------------------------------------------------------
+
+    def _paths_for(self, video_id, filename):
+        paths = [os.path.join(self.root, filename), os.path.join(self.root, video_id + POSTER_EXTENSION)]
+        if os.sep in filename or "/" in filename:
+            # HLS output lives in its own directory
+            paths[0] = os.path.join(self.root, video_id)
+        return paths
+
+    # Registration / lookup -------------------------------------------------
+
+    def register(self, video_id, filename, url, content_hash=None, response=None):
+        """Record a finished video. `filename` is relative to the videos directory"""
+        # The poster is evicted with the video, so it counts towards its size
+        size = paths_size(self._paths_for(video_id, filename))
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO videos VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (video_id, filename, url, size, now, now, content_hash, response),
+            )
+            self._db.commit()
+
+    def refresh_size(self, video_id):
+        """Recount the size of a video, e.g. after its poster was generated"""
+        with self._lock:
+            row = self._db.execute("SELECT filename FROM videos WHERE video_id = ?", (video_id,)).fetchone()
+        if row is None:
+            return
+        size = paths_size(self._paths_for(video_id, row[0]))
+        with self._lock:
+            self._db.execute("UPDATE videos SET size = ? WHERE video_id = ?", (size, video_id))
+            self._db.commit()
+
+    def lookup(self, content_hash):
+        """
+        Return (video_id, cached response as stored, i.e. encoded JSON) of a
+        previous identical submission if it is still on disk, otherwise None.
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT video_id, filename, response FROM videos WHERE content_hash = ?", (content_hash,)
+            ).fetchone()
+        if row is None or row[2] is None:
+            return None
+
+        video_id, filename, response = row
+        if not os.path.exists(self._paths_for(video_id, filename)[0]):
+            # Deleted behind our back, forget about it
+            self._forget(video_id)
+            return None
+
+        self.dedup_hits += 1
+        self.touch(video_id)
+        return video_id, response
+
+    def response_for(self, video_id):
+        """Return the stored (JSON) response of a video, e.g. for jobs that finished on another worker"""
+        with self._lock:
+            row = self._db.execute("SELECT response FROM videos WHERE video_id = ?", (video_id,)).fetchone()
+        return row[0] if row is not None else None
+
+    def touch(self, video_id):
+        now = time.time()
+        if now - self._last_touch.get(video_id, 0) < TOUCH_RESOLUTION_SECONDS:
+            return
+        self._last_touch[video_id] = now
+        with self._lock:
+            self._db.execute("UPDATE videos SET last_access = ? WHERE video_id = ?", (now, video_id))
+            self._db.commit()
+
+    def touch_path(self, path):
+        """Mark the video owning a path below the videos directory as accessed"""
+        relative = os.path.relpath(path, self.root)
+        video_id = relative.split(os.sep, 1)[0]
+        self.touch(os.path.splitext(video_id)[0])
+
+    def list_videos(self):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT video_id, filename, url, created_at, size FROM videos ORDER BY created_at DESC"
+            ).fetchall()
+        return [
+            {"video_id": video_id, "filename": filename, "url": url, "created_at": created_at, "size": size}
+            for video_id, filename, url, created_at, size in rows
+        ]
+
+    def _forget(self, video_id):
+        with self._lock:
+            self._db.execute("DELETE FROM videos WHERE video_id = ?", (video_id,))
+            self._db.commit()
+        self._last_touch.pop(video_id, None)
+
+    def rescan(self):
+        """Adopt videos already on disk that are not in the index (e.g. created before it existed)"""
+        with self._lock:
+            known = {row[0] for row in self._db.execute("SELECT video_id FROM videos")}
+
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name.endswith(VIDEO_EXTENSIONS):
+                video_id, filename, url = os.path.splitext(name)[0], name, f"/videos/{name}"
+            elif os.path.isdir(path) and os.path.exists(os.path.join(path, "index.m3u8")):
+                video_id, filename, url = name, f"{name}/index.m3u8", f"/videos/{name}/index.m3u8"
+            else:
+                continue
+            if video_id in known:
+                continue
+
+            stat_result = os.stat(path)
+            with self._lock:
+                self._db.execute(
+                    "INSERT OR IGNORE INTO videos VALUES (?, ?, ?, ?, ?, ?, NULL, NULL)",
+                    (video_id, filename, url, paths_size(self._paths_for(video_id, filename)),
+                     stat_result.st_ctime, stat_result.st_atime),
+                )
+                self._db.commit()
+
+    # Eviction --------------------------------------------------------------
+
+    def _delete(self, video_id, filename):
+        for path in self._paths_for(video_id, filename):
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.exists(path):
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    print(f"Error removing {path}: {e}")
+        self._forget(video_id)
+        self.evicted_count += 1
+
+    def sweep(self):
+        """Evict expired videos, then least recently accessed ones until under quota"""
+        now = time.time()
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT video_id, filename, size, last_access FROM videos ORDER BY last_access ASC"
+            ).fetchall()
+
+        total = sum(row[2] for row in rows)
+        for video_id, filename, size, last_access in rows:
+            expired = self.retention_seconds and now - last_access > self.retention_seconds
+            over_quota = self.quota_bytes and total > self.quota_bytes
+            if not (expired or over_quota):
+                # Rows are ordered by last access, nothing further qualifies
+                break
+            self._delete(video_id, filename)
+            total -= size
+
+        self.last_sweep = now
+
+    def _run_sweeper(self):
+        while not self._stop.wait(self.sweep_interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"Error sweeping video storage: {e}")
+
+    def start_sweeper(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run_sweeper, name="video-storage-sweeper", daemon=True)
+            self._thread.start()
+
+    def stop_sweeper(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    # Statistics ------------------------------------------------------------
+
+    def stats(self):
+        with self._lock:
+            count, total, oldest = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0), MIN(last_access) FROM videos"
+            ).fetchone()
+        disk = shutil.disk_usage(self.root)
+        return {
+            "video_count": count,
+            "used_bytes": total,
+            "quota_bytes": self.quota_bytes,
+            "quota_used_percent": round(100 * total / self.quota_bytes, 2) if self.quota_bytes else None,
+            "retention_seconds": self.retention_seconds,
+            "oldest_access": oldest,
+            "evicted_count": self.evicted_count,
+            "dedup_hits": self.dedup_hits,
+            "last_sweep": self.last_sweep,
+            "disk_free_bytes": disk.free,
+        }
@@ -0,0 +1,199 @@
+"""
+Parallel chunked video encoding.
+
+The annotated frame sequence is split into fixed-size chunks which are
+encoded independently (each starting with its own keyframe) in a process
+pool. The chunks are then joined with ffmpeg's concat demuxer using stream
+copy, so nothing is re-encoded and frame count and timing match what a
+single imageio writer would produce.
+
+Configuration comes from environment variables so that both the FastAPI
+backend and the Streamlit app can be tuned without code changes:
+
+    VIDEO_CODEC          libx264 (default) or libx265
+    VIDEO_PRESET         encoder preset, default "medium"
+    VIDEO_CRF            constant rate factor, default 25 (imageio's default quality)
+    VIDEO_ENCODE_WORKERS pool size, default os.cpu_count()
+    VIDEO_CHUNK_FRAMES   frames per chunk, default 64
+"""
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import imageio_ffmpeg
+
+SUPPORTED_CODECS = ("libx264", "libx265")
+
+DEFAULT_CODEC = os.environ.get("VIDEO_CODEC", "libx264")
+DEFAULT_PRESET = os.environ.get("VIDEO_PRESET", "medium")
+DEFAULT_CRF = int(os.environ.get("VIDEO_CRF", "25"))
+DEFAULT_WORKERS = int(os.environ.get("VIDEO_ENCODE_WORKERS", "0")) or os.cpu_count() or 1
+DEFAULT_CHUNK_FRAMES = int(os.environ.get("VIDEO_CHUNK_FRAMES", "64"))
+
+# Shared pools, keyed by size, so repeated jobs don't pay process start-up
+_pools = {}
+# Jobs run in worker threads, concurrent first jobs must not each start a pool
+_pools_lock = threading.Lock()
+
+
+def get_encoder_pool(workers):
+    with _pools_lock:
+        pool = _pools.get(workers)
+        if pool is None:
+            # Spawn rather than fork: the API server and Streamlit both run threads
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+            _pools[workers] = pool
+        return pool
+
+
+def shutdown_encoder_pools():
+    """Stop the encoder processes, e.g. on application shutdown"""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.shutdown(cancel_futures=True)
+
+
+def encoder_threads(workers):
+    """Encoder threads per chunk so that `workers` concurrent encodes fill the CPUs without oversubscribing them"""
+    return max(1, (os.cpu_count() or 1) // workers)
+
+
+def encode_chunk(frames, chunk_path, fps, codec, preset, crf, threads):
+    """Encode a stacked (N, H, W, 3) RGB array into a standalone mp4 chunk"""
+    height, width = frames.shape[1:3]
+    gen = imageio_ffmpeg.write_frames(
+        chunk_path,
+        (width, height),
+        fps=fps,
+        codec=codec,
+        quality=None,  # Rate control is given explicitly through -crf
+        output_params=["-preset", preset, "-crf", str(crf), "-threads", str(threads)],
+    )
+    gen.send(None)
+    for frame in frames:
+        gen.send(np.ascontiguousarray(frame))
+    gen.close()
+    return chunk_path
+
+
+class ParallelVideoEncoder:
+    """
+    imageio-style writer (append_data/close) that encodes chunks of frames in
+    a process pool and joins them into a single mp4 on close().
+
+    Chunks are submitted as soon as they fill up, so encoding overlaps with
+    whatever is producing the frames.
+    """
+
+    def __init__(self, path, fps, codec=None, preset=None, crf=None, workers=None,
+                 chunk_frames=None, movflags="+faststart"):
+        self.path = path
+        self.fps = fps
+        self.codec = codec or DEFAULT_CODEC
+        self.preset = preset or DEFAULT_PRESET
+        self.crf = DEFAULT_CRF if crf is None else crf
+        self.workers = workers or DEFAULT_WORKERS
+        self.chunk_frames = chunk_frames or DEFAULT_CHUNK_FRAMES
+        self.movflags = movflags
+
+        if self.codec not in SUPPORTED_CODECS:
+            raise ValueError(
+                f"Unsupported codec '{self.codec}' for parallel encoding, "
+                f"expected one of {', '.join(SUPPORTED_CODECS)}"
+            )
+
+        # Chunks live in the system temp directory, never next to the served output
+        self._tmp_dir = tempfile.mkdtemp(prefix="ocean_view_chunks_")
+        self._pending = []
+        self._futures = []
+        self._chunk_paths = []
+        self._frame_shape = None
+
+    def append_data(self, frame):
+        if self._frame_shape is None:
+            self._frame_shape = frame.shape
+        elif frame.shape != self._frame_shape:
+            # Same constraint as the single ffmpeg writer: one size per video
+            raise ValueError(f"All frames must have the same shape, got {frame.shape} and {self._frame_shape}")
+
+        self._pending.append(frame)
+        if len(self._pending) >= self.chunk_frames:
+            self._submit_pending()
+
+    def _next_chunk_path(self):
+        chunk_path = os.path.join(self._tmp_dir, f"chunk_{len(self._chunk_paths):05d}.mp4")
+        self._chunk_paths.append(chunk_path)
+        return chunk_path
+
+    def _submit_pending(self):
+        frames = np.stack(self._pending)
+        self._pending = []
+        args = (frames, self._next_chunk_path(), self.fps, self.codec, self.preset, self.crf)
+        if self.workers <= 1:
+            encode_chunk(*args, encoder_threads(1))
+        else:
+            self._futures.append(
+                get_encoder_pool(self.workers).submit(encode_chunk, *args, encoder_threads(self.workers))
+            )
+
+    def close(self):
+        try:
+            if self._pending:
+                if not self._futures and self.workers > 1:
+                    # Everything fits in one chunk: not worth a round trip to the pool
+                    frames = np.stack(self._pending)
+                    self._pending = []
+                    encode_chunk(
+                        frames, self._next_chunk_path(), self.fps, self.codec, self.preset, self.crf,
+                        encoder_threads(1)
+                    )
+                else:
+                    self._submit_pending()
+
+            for future in self._futures:
+                future.result()
+
+            if self._chunk_paths:
+                self._join_chunks()
+        finally:
+            shutil.rmtree(self._tmp_dir, ignore_errors=True)
+
+    def abort(self):
+        """Drop a video that will not be finished: cancel queued chunks and remove the temporary files"""
+        for future in self._futures:
+            future.cancel()
+        self._futures = []
+        self._pending = []
+        shutil.rmtree(self._tmp_dir, ignore_errors=True)
+
+    def _join_chunks(self):
+        # Each chunk starts with a keyframe and has the same codec parameters,
+        # so the concat demuxer can stream-copy them back to back; chunk
+        # timestamps are offset by the exact duration of the previous chunks.
+        list_path = os.path.join(self._tmp_dir, "chunks.txt")
+        with open(list_path, "w") as f:
+            for chunk_path in self._chunk_paths:
+                f.write(f"file '{chunk_path}'\n")
+
+        cmd = [
+            imageio_ffmpeg.get_ffmpeg_exe(), "-y", "-v", "error",
+            "-f", "concat", "-safe", "0",
+            "-i", list_path,
+            "-c", "copy",
+        ]
+        if self.codec == "libx265":
+            cmd += ["-tag:v", "hvc1"]  # Needed for Safari to play HEVC in mp4
+        if self.movflags:
+            cmd += ["-movflags", self.movflags]
+        cmd.append(self.path)
+
+        result = subprocess.run(cmd, capture_output=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"Joining video chunks failed: {result.stderr.decode(errors='replace')}")
@@ -0,0 +1,359 @@
+"""
+Video output helpers for the detection API.
+
+Writers here produce files that browsers can start playing before the whole
+file has been downloaded (faststart / fragmented MP4, or HLS segments plus a
+playlist), and the response helpers serve them with Range, ETag and
+cache headers.
+"""
+import os
+import shutil
+import mimetypes
+from email.utils import formatdate, parsedate_to_datetime
+
+import cv2
+import imageio
+import imageio_ffmpeg
+from fastapi import HTTPException
+from fastapi.staticfiles import StaticFiles
+from starlette.requests import Request
+from starlette.responses import Response, StreamingResponse
+
+from video_encoder import ParallelVideoEncoder
+
+VIDEOS_DIR = "videos"
+
+# Supported values for the `output_format` form field
+OUTPUT_FORMATS = ("mp4", "fmp4", "hls")
+
+# Formats that can be played while they are being written
+STREAMING_OUTPUT_FORMATS = ("fmp4", "hls")
+
+# HLS target segment duration in seconds
+HLS_SEGMENT_SECONDS = 2
+
+# Size of the blocks streamed back for (partial) file responses
+CHUNK_SIZE = 256 * 1024
+
+mimetypes.add_type("application/vnd.apple.mpegurl", ".m3u8")
+mimetypes.add_type("video/iso.segment", ".m4s")
+mimetypes.add_type("video/mp4", ".mp4")
+
+
+def new_video_target(video_id, output_format="mp4"):
+    """Return (filesystem path, public URL) for a new video of the given format"""
+    if output_format not in OUTPUT_FORMATS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unsupported output_format '{output_format}', expected one of {', '.join(OUTPUT_FORMATS)}"
+        )
+
+    if output_format == "hls":
+        # HLS output is a directory holding the playlist, init segment and media segments
+        video_dir = os.path.join(VIDEOS_DIR, video_id)
+        os.makedirs(video_dir, exist_ok=True)
+        return os.path.join(video_dir, "index.m3u8"), f"/videos/{video_id}/index.m3u8"
+
+    video_filename = f"{video_id}.mp4"
+    return os.path.join(VIDEOS_DIR, video_filename), f"/videos/{video_filename}"
+
+
+def get_video_writer(video_path, fps, output_format="mp4"):
+    """
+    Open an imageio/ffmpeg writer for the requested output format.
+
+    - mp4:  regular mp4 with the moov atom moved to the front (faststart),
+            encoded in parallel chunks across a process pool
+    - fmp4: fragmented mp4 with one fragment per keyframe, playable while written
+    - hls:  fMP4 HLS segments plus an `event` playlist that grows as frames arrive
+    """
+    # One keyframe per second so fragments / segments can be cut regularly.
+    # While the job is running they must reach the disk promptly: limit the
+    # encoder lookahead to one GOP and flush every packet instead of
+    # buffering output in ffmpeg
+    keyint = str(max(int(fps), 1))
+    gop = ["-g", keyint, "-rc-lookahead", keyint, "-flush_packets", "1"]
+
+    if output_format == "fmp4":
+        params = gop + ["-movflags", "+frag_keyframe+empty_moov+default_base_moof"]
+    elif output_format == "hls":
+        video_dir = os.path.dirname(video_path)
+        params = gop + [
+            "-f", "hls",
+            "-hls_time", str(HLS_SEGMENT_SECONDS),
+            "-hls_list_size", "0",
+            "-hls_playlist_type", "event",
+            "-hls_segment_type", "fmp4",
+            "-hls_fmp4_init_filename", "init.mp4",
+            "-hls_segment_filename", os.path.join(video_dir, "segment_%05d.m4s"),
+        ]
+        # imageio refuses targets it does not recognise by extension, so the
+        # playlist is written through imageio-ffmpeg (imageio's own backend)
+        return HLSWriter(video_path, fps, params)
+    else:
+        return ParallelVideoEncoder(video_path, fps, movflags="+faststart")
+
+    return imageio.get_writer(video_path, format="FFMPEG", fps=fps, ffmpeg_params=params)
+
+
+class HLSWriter:
+    """Minimal imageio-style writer (append_data/close) producing an HLS playlist"""
+
+    def __init__(self, path, fps, output_params):
+        self.path = path
+        self.fps = fps
+        self.output_params = output_params
+        self._gen = None
+        self._frame_shape = None
+
+    def append_data(self, frame):
+        if self._frame_shape is None:
+            self._frame_shape = frame.shape
+        elif frame.shape != self._frame_shape:
+            # ffmpeg would read the raw frames misaligned and corrupt the stream
+            raise ValueError(f"All frames must have the same shape, got {frame.shape} and {self._frame_shape}")
+        if self._gen is None:
+            # The frame size is only known once the first frame arrives
+            height, width = frame.shape[:2]
+            self._gen = imageio_ffmpeg.write_frames(
+                self.path,
+                (width, height),
+                fps=self.fps,
+                codec="libx264",
+                pix_fmt_out="yuv420p",
+                output_params=self.output_params,
+            )
+            self._gen.send(None)
+        self._gen.send(frame)
+
+    def close(self):
+        if self._gen is not None:
+            self._gen.close()
+            self._gen = None
+
+
+def discard_video(video_id, video_path, writer=None):
+    """Stop the writer of a failed job and remove everything it produced, poster included"""
+    if writer is not None:
+        try:
+            if hasattr(writer, "abort"):
+                writer.abort()
+            else:
+                writer.close()
+        except Exception as e:
+            print(f"Error closing writer of discarded video {video_id}: {e}")
+
+    if video_path.endswith(".m3u8"):
+        shutil.rmtree(os.path.dirname(video_path), ignore_errors=True)
+    for path in (video_path, poster_path_for(video_id)):
+        if os.path.isfile(path):
+            try:
+                os.remove(path)
+            except OSError as e:
+                print(f"Error removing {path}: {e}")
+
+
+def poster_path_for(video_id):
+    return os.path.join(VIDEOS_DIR, f"{video_id}.jpg")
+
+
+def save_poster(video_id, frame):
+    """Write the poster thumbnail for a video from a BGR frame, once"""
+    poster_path = poster_path_for(video_id)
+    if not os.path.exists(poster_path):
+        height, width = frame.shape[:2]
+        # Keep posters small, they are only used as a placeholder before playback
+        scale = min(1.0, 640 / max(width, 1))
+        if scale < 1.0:
+            frame = cv2.resize(frame, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+        cv2.imwrite(poster_path, frame, [cv2.IMWRITE_JPEG_QUALITY, 85])
+    return poster_path
+
+
+def ensure_poster(video_id):
+    """
+    Return the cached poster for a video, generating it from the first frame
+    of the video if it does not exist yet (e.g. videos created before posters).
+    """
+    poster_path = poster_path_for(video_id)
+    if os.path.exists(poster_path):
+        return poster_path
+
+    candidates = [
+        os.path.join(VIDEOS_DIR, f"{video_id}.mp4"),
+        os.path.join(VIDEOS_DIR, video_id, "index.m3u8"),
+    ]
+    for video_path in candidates:
+        if not os.path.exists(video_path):
+            continue
+        cap = cv2.VideoCapture(video_path)
+        try:
+            ret, frame = cap.read()
+        finally:
+            cap.release()
+        if ret:
+            return save_poster(video_id, frame)
+
+    return None
+
+
+def resolve_video_path(relative_path):
+    """Resolve a path below the videos directory, rejecting path traversal"""
+    root = os.path.realpath(VIDEOS_DIR)
+    full_path = os.path.realpath(os.path.join(root, relative_path))
+    if os.path.commonpath([root, full_path]) != root or is_hidden(full_path):
+        raise HTTPException(status_code=404, detail="Video not found")
+    return full_path
+
+
+def is_hidden(path):
+    # Dotfiles in the videos directory (e.g. the storage index) are private
+    return os.path.basename(path).startswith(".")
+
+
+def partial_marker_for(video_path):
+    """Hidden file that exists next to a video while it is still being written"""
+    return os.path.join(os.path.dirname(video_path), f".{os.path.basename(video_path)}.partial")
+
+
+def is_partial(video_path):
+    return os.path.exists(partial_marker_for(video_path))
+
+
+def cache_control_for(path):
+    # Playlists and videos still being written keep growing while a job is
+    # running; everything else is written once under a unique name and can
+    # be cached aggressively.
+    if path.endswith(".m3u8") or is_partial(path):
+        return "no-cache"
+    return "public, max-age=86400"
+
+
+def make_etag(stat_result):
+    return f'"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+
+
+def parse_range(range_header, file_size):
+    """
+    Parse a single `bytes=` range. Returns (start, end) inclusive, None if the
+    header should be ignored, or raises ValueError when it is unsatisfiable.
+    """
+    if not range_header or not range_header.startswith("bytes="):
+        return None
+    spec = range_header[len("bytes="):].strip()
+    if "," in spec:
+        # Multipart ranges are not worth supporting for video, serve the whole file
+        return None
+
+    start_str, _, end_str = spec.partition("-")
+    try:
+        if start_str == "":
+            # Suffix range: the last N bytes
+            length = int(end_str)
+            if length <= 0:
+                raise ValueError("empty suffix range")
+            start = max(file_size - length, 0)
+            end = file_size - 1
+        else:
+            start = int(start_str)
+            end = int(end_str) if end_str else file_size - 1
+    except ValueError:
+        raise ValueError(f"Invalid range: {range_header}")
+
+    end = min(end, file_size - 1)
+    if start >= file_size or start > end:
+        raise ValueError(f"Unsatisfiable range: {range_header}")
+    return start, end
+
+
+def iter_file(path, start, length):
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = length
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def not_modified(request, etag, stat_result):
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*"
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(stat_result.st_mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def video_file_response(request, path, stat_result=None):
+    """Serve a video (or playlist / segment / poster) with Range, ETag and cache headers"""
+    if stat_result is None:
+        stat_result = os.stat(path)
+
+    file_size = stat_result.st_size
+    etag = make_etag(stat_result)
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Last-Modified": formatdate(stat_result.st_mtime, usegmt=True),
+        "Cache-Control": cache_control_for(path),
+    }
+    media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+    if not_modified(request, etag, stat_result):
+        return Response(status_code=304, headers=headers)
+
+    # Only honour Range if the client's validator (if any) still matches
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if if_range and if_range != etag:
+        range_header = None
+
+    try:
+        byte_range = parse_range(range_header, file_size)
+    except ValueError:
+        headers["Content-Range"] = f"bytes */{file_size}"
+        return Response(status_code=416, headers=headers)
+
+    if byte_range is None:
+        start, end, status_code = 0, file_size - 1, 200
+    else:
+        start, end = byte_range
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{file_size}"
+
+    length = end - start + 1 if file_size else 0
+    headers["Content-Length"] = str(length)
+
+    if request.method == "HEAD":
+        return Response(status_code=status_code, headers=headers, media_type=media_type)
+
+    return StreamingResponse(
+        iter_file(path, start, length),
+        status_code=status_code,
+        headers=headers,
+        media_type=media_type,
+    )
+
+
+class VideoStaticFiles(StaticFiles):
+    """StaticFiles for the /videos mount that supports Range requests and cache headers"""
+
+    def __init__(self, *args, on_access=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Called with the served path, used to track last access for eviction
+        self.on_access = on_access
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        if is_hidden(full_path):
+            return Response(status_code=404)
+        if self.on_access is not None:
+            self.on_access(full_path)
+        return video_file_response(Request(scope), full_path, stat_result)
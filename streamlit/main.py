@@ -1,17 +1,21 @@
 
 import os
+import sys
 os.environ["OPENCV_AVFOUNDATION_SKIP_AUTH"] = "1"  # Prevents OpenCV GUI errors
 os.environ["QT_QPA_PLATFORM"] = "offscreen"  # Ensures OpenCV does not use a GUI-based backend
+# Shared helpers live next to the FastAPI backend
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "main_app"))
 import streamlit as st
 import cv2
 import numpy as np
 import tempfile
-import imageio
 import time
 import pygame
 from gtts import gTTS
 from ultralytics import YOLO
-from PIL import Image, ImageDraw
+from annotation import AnnotationRenderer, label_text
+from frame_gate import CHANGE_THRESHOLD, MAX_SKIPPED_FRAMES, ChangeGate
+from video_encoder import ParallelVideoEncoder
 
 # Initialize session state variables
 if "detection_count" not in st.session_state:
@@ -261,27 +265,41 @@ with st.sidebar:
     # FPS Control
     fps = st.slider("Frames per Second", min_value=1, max_value=30, value=10) #fps changed to 10 for better performance
     confidence_threshold = st.sidebar.slider("Confidence Threshold", 0.1, 1.0, 0.5)
+    # Frames that barely change reuse the previous detections (0 = run the model on every frame)
+    change_threshold = st.sidebar.slider("Change Threshold", 0.0, 20.0, CHANGE_THRESHOLD)
+    # The environment default may exceed the slider range
+    max_skipped_frames = st.sidebar.slider("Force Detection Every N Frames", 1, 60, max(1, min(MAX_SKIPPED_FRAMES, 60)))
 
 def update_elapsed_time():
     elapsed = time.time() - st.session_state.session_start
     minutes, seconds = divmod(int(elapsed), 60)
     elapsed_placeholder.markdown(f"Duration: {minutes:02d}:{seconds:02d}")
 
-def predict_frame(frame):
-    results = model(frame)
-    detections = 0
-    for r in results:
-        for box in r.boxes:
-            conf = box.conf[0].item()
-            if conf < confidence_threshold:  # Apply confidence threshold
-                continue  
-            detections += 1
-            x1, y1, x2, y2 = map(int, box.xyxy[0])
-            label = model.model.names[int(box.cls[0])]
-
-            cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
-            text = f"{label} ({conf:.2f})"
-            cv2.putText(frame, text, (x1, y1 - 5), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
+# Shared annotation renderers (BGR, in place)
+frame_renderer = AnnotationRenderer()
+speech_renderer = AnnotationRenderer(box_thickness=3, font_scale=0.4, text_thickness=1, text_offset=10, fill_alpha=100 / 255)
+
+def predict_frame(frame, gate=None):
+    if gate is not None and not gate.should_infer(frame):
+        # Scene unchanged since the last inferred frame, reuse its detections
+        boxes, labels = gate.result
+    else:
+        results = model(frame)
+        boxes, labels = [], []
+        for r in results:
+            for box in r.boxes:
+                conf = box.conf[0].item()
+                if conf < confidence_threshold:  # Apply confidence threshold
+                    continue  
+                x1, y1, x2, y2 = map(int, box.xyxy[0])
+                label = model.model.names[int(box.cls[0])]
+                boxes.append((x1, y1, x2, y2))
+                labels.append(label_text(label, conf))
+        if gate is not None:
+            gate.result = (boxes, labels)
+    
+    frame_renderer.draw(frame, boxes, labels, [(0, 255, 0)] * len(boxes))
+    detections = len(boxes)
     
     st.session_state.detection_count += detections
     st.session_state.processed_frames += 1
@@ -326,19 +344,21 @@ def play_audio(audio_path):
         time.sleep(1)
 
 def draw_detections(image, results):
-    draw = ImageDraw.Draw(image, "RGBA")
-    img_width, img_height = image.size
+    # Works in place on a BGR frame: fills are blended in one pass, then outlines and labels
+    img_height, img_width = image.shape[:2]
     detected_objects = []
+    boxes, colors = [], []
     for result in results:
         for box in result.boxes:
             class_id = int(box.cls[0])
             class_name = model.names[class_id]
             x1, y1, x2, y2 = map(int, box.xyxy[0])
             detected_objects.append((class_name, x1, y1, x2, y2))
-            box_color, mask_color = ("red", (255, 0, 0, 100)) if class_name in hazardous_trash else ("blue", (0, 0, 255, 100)) if class_name in non_hazardous_trash else ("green", (0, 255, 0, 100)) if class_name in aquatic_life else ("yellow", (255, 255, 0, 100))
-            draw.rectangle([x1, y1, x2, y2], outline=box_color, width=3)
-            draw.rectangle([x1, y1, x2, y2], fill=mask_color)
-            draw.text((x1, y1 - 10), class_name, fill="yellow")
+            boxes.append((x1, y1, x2, y2))
+            # Red / blue / green / yellow in BGR
+            colors.append((0, 0, 255) if class_name in hazardous_trash else (255, 0, 0) if class_name in non_hazardous_trash else (0, 255, 0) if class_name in aquatic_life else (0, 255, 255))
+    labels = [class_name for class_name, *_ in detected_objects]
+    speech_renderer.draw(image, boxes, labels, colors, label_colors=[(0, 255, 255)] * len(boxes))
     return image, detected_objects, img_width, img_height
 
 # Main content area
@@ -374,18 +394,21 @@ if detection_mode == "📂 Upload Frames":
             else:
                 # Get reference size from first image
                 height, width = images[0].shape[:2]
+                gate = ChangeGate(change_threshold, max_skipped_frames)
 
                 for i, img in enumerate(images):
                     img_resized = cv2.resize(img, (width, height))  # Resize all images to match
-                    frames.append(predict_frame(img_resized))  # Process resized frame
+                    frames.append(predict_frame(img_resized, gate))  # Process resized frame
                     progress_bar.progress((i + 1) / len(images))
 
+                st.caption(f"Model ran on {gate.inferred} frames, {gate.skipped} unchanged frames reused detections")
+
                 st.markdown("### 🎥 Results")
 
                 # Generate video
                 temp_video = tempfile.NamedTemporaryFile(delete=False, suffix=".mp4")
                 temp_video_path = temp_video.name
-                writer = imageio.get_writer(temp_video_path, fps=fps)
+                writer = ParallelVideoEncoder(temp_video_path, fps)
 
                 for frame in frames:
                     writer.append_data(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
@@ -432,10 +455,8 @@ elif detection_mode == "🖼 Upload Image":
 
                 if st.button("🗣 Generate Speech Image"):
                     results = model(img)  # Ensure `model` is defined and loaded
-                    processed_image, detections, img_width, img_height = draw_detections(
-                        Image.fromarray(cv2.cvtColor(img, cv2.COLOR_BGR2RGB)), results
-                    )
-                    st.image(np.array(processed_image), use_column_width=True)
+                    processed_image, detections, img_width, img_height = draw_detections(img.copy(), results)
+                    st.image(processed_image, channels="BGR", use_column_width=True)
 
                     audio_path = generate_voice_alert(detections, img_width, img_height)
                     if audio_path:
@@ -462,6 +483,8 @@ elif detection_mode == "🎥 Real-time Camera":
         if st.session_state.camera_active:
             cam = cv2.VideoCapture(0)
             frame_placeholder = st.empty()
+            gate_placeholder = st.empty()
+            gate = ChangeGate(change_threshold, max_skipped_frames)
             
             while st.session_state.camera_active:
                 ret, frame = cam.read()
@@ -470,7 +493,8 @@ elif detection_mode == "🎥 Real-time Camera":
                     break
                 
                 frame = cv2.resize(frame, (1280, 720))
-                frame_placeholder.image(predict_frame(frame), channels="BGR")
+                frame_placeholder.image(predict_frame(frame, gate), channels="BGR")
+                gate_placeholder.caption(f"Inferred frames: {gate.inferred} | Skipped (unchanged): {gate.skipped}")
                 update_elapsed_time()
                 time.sleep(1/fps)
             